@@ -0,0 +1,360 @@
+# triedict
+#
+# Copyright (c) 2015 Christian Sengstock, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+
+"""
+# triedict benchmarks #
+
+Times the main operations of TrieDict on reproducible
+synthetic corpora:
+* zipf: words with Zipf-distributed frequencies in the texts
+* urls: URLs built from the words
+* entities: multi-word names of non-ASCII characters
+
+For each corpus the bulk build (#add_pattern()), the suffix link
+generation, #get(), #prefix_search(), #parse() with and without
+bound chars, and #save()/#load() are timed. Each corpus runs in its
+own process, such that its peak RSS is not affected by the other
+corpora. The results (throughput, node counts and peak RSS) are
+written as JSON and can be compared against a stored baseline that
+was run with the same parameters.
+
+## Usage ##
+python bench_triedict.py --output baseline.json
+python bench_triedict.py --baseline baseline.json --tolerance 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import bisect
+import argparse
+import platform
+import multiprocessing
+import resource
+import tempfile
+from triedict import TrieDict, DEF_BOUND_CHARS
+
+CORPORA = ["zipf", "urls", "entities"]
+
+ALPHABET = u"abcdefghijklmnopqrstuvwxyz"
+UNICODE_ALPHABET = u"".join([unichr(i) for i in range(0xe0, 0x100) +
+                                                 range(0x3b1, 0x3ca) +
+                                                 range(0x430, 0x450)])
+TLDS = ["com", "org", "net", "de", "io"]
+
+# parameters that must be equal to compare two runs
+COMPARED_META = ["seed", "n_patterns", "text_length", "density"]
+
+# CORPORA ////////////////////////////////////////////////////////////////
+
+def random_word(rnd, alphabet, min_len=2, max_len=12):
+    n = rnd.randint(min_len, max_len)
+    return u"".join([rnd.choice(alphabet) for i in xrange(n)])
+
+def zipf_words(rnd, n, alphabet=ALPHABET):
+    """
+    Returns n distinct random words. The position of a word
+    in the list is its frequency rank (see ZipfSampler).
+    """
+    words = []
+    seen = set()
+    while len(words) < n:
+        word = random_word(rnd, alphabet)
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def urls(rnd, n, words):
+    res = set()
+    while len(res) < n:
+        path = u"/".join([rnd.choice(words) for i in xrange(rnd.randint(0, 3))])
+        res.add(u"http://www.%s.%s/%s" % (rnd.choice(words), rnd.choice(TLDS), path))
+    return sorted(res)
+
+def entities(rnd, n):
+    res = set()
+    while len(res) < n:
+        res.add(u" ".join([random_word(rnd, UNICODE_ALPHABET, 3, 9).capitalize()
+                           for i in xrange(rnd.randint(1, 3))]))
+    return sorted(res)
+
+class ZipfSampler(object):
+    """
+    Draws items with a probability proportional to 1/rank.
+    """
+
+    def __init__(self, rnd, items):
+        self._rnd = rnd
+        self._items = items
+        self._cum_weights = []
+        total = 0.0
+        for rank in xrange(1, len(items) + 1):
+            total += 1.0 / rank
+            self._cum_weights.append(total)
+
+    def sample(self):
+        x = self._rnd.random() * self._cum_weights[-1]
+        return self._items[bisect.bisect_left(self._cum_weights, x)]
+
+def random_text(rnd, patterns, filler, length, density):
+    """
+    Returns a text of about [length] characters. Each
+    space-separated token is a pattern with probability
+    [density] and a filler word otherwise. Both are drawn
+    from a Zipf distribution.
+    """
+    pattern_sampler = ZipfSampler(rnd, patterns)
+    filler_sampler = ZipfSampler(rnd, filler)
+    tokens = []
+    n = 0
+    while n < length:
+        if rnd.random() < density:
+            token = pattern_sampler.sample()
+        else:
+            token = filler_sampler.sample()
+        tokens.append(token)
+        n += len(token) + 1
+    return u" ".join(tokens)
+
+def make_corpus(name, n_patterns, text_length, density, seed):
+    """
+    Returns (patterns, queries, text) of corpus [name]. Half of
+    the queries are stored patterns, the others are random words.
+    """
+    rnd = random.Random("%s-%d" % (name, seed))
+    if name == "zipf":
+        patterns = zipf_words(rnd, n_patterns)
+        filler = zipf_words(rnd, 1000)
+    elif name == "urls":
+        patterns = urls(rnd, n_patterns, zipf_words(rnd, max(n_patterns/10, 10)))
+        filler = zipf_words(rnd, 1000)
+    elif name == "entities":
+        patterns = entities(rnd, n_patterns)
+        filler = zipf_words(rnd, 1000, UNICODE_ALPHABET)
+    else:
+        raise ValueError("unknown corpus %s!" % name)
+    queries = [rnd.choice(patterns) for i in xrange(n_patterns/2)] + \
+              [random_word(rnd, ALPHABET) for i in xrange(n_patterns/2)]
+    rnd.shuffle(queries)
+    text = random_text(rnd, patterns, filler, text_length, density)
+    return patterns, queries, text
+
+# BENCHMARKS /////////////////////////////////////////////////////////////
+
+def peak_rss_kb():
+    """
+    Peak resident set size of the process in KB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss
+
+def timed(fn, repeat):
+    """
+    Returns (best time in seconds, result of the last call).
+    """
+    best = None
+    res = None
+    for i in xrange(repeat):
+        t0 = time.time()
+        res = fn()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best, res
+
+def result(seconds, n, unit, **extra):
+    # avoid infinite throughputs of operations below the timer resolution
+    seconds = max(seconds, 1e-6)
+    res = {"seconds": seconds,
+           "throughput": n / seconds,
+           "unit": unit}
+    res.update(extra)
+    return res
+
+def bench_corpus(name, patterns, queries, text, repeat, tmp_dir):
+    res = {}
+
+    def build():
+        triedict = TrieDict()
+        for i, pattern in enumerate(patterns):
+            triedict.add_pattern(pattern, i)
+        return triedict
+    t, triedict = timed(build, repeat)
+    res["add_pattern"] = result(t, len(patterns), "patterns/s",
+                                symbols=sum([len(p) for p in patterns]))
+
+    def generate():
+        triedict.generate_suffix_links(verbose=False)
+    t, _ = timed(generate, repeat)
+    res["generate_suffix_links"] = result(t, triedict.num_of_nodes(), "nodes/s")
+
+    def get():
+        return sum([1 for q in queries if triedict.get(q) is not None])
+    t, hits = timed(get, repeat)
+    res["get"] = result(t, len(queries), "queries/s", hits=hits)
+
+    prefixes = [q[:max(len(q)/2, 1)] for q in queries]
+    def prefix_search():
+        return sum([len(triedict.prefix_search(p)) for p in prefixes])
+    t, n_res = timed(prefix_search, repeat)
+    res["prefix_search"] = result(t, len(prefixes), "queries/s", results=n_res)
+
+    t, matched = timed(lambda: triedict.parse(text), repeat)
+    res["parse"] = result(t, len(text), "symbols/s", matches=len(matched))
+
+    t, matched = timed(lambda: triedict.parse(text, bound_chars=DEF_BOUND_CHARS), repeat)
+    res["parse_bound_chars"] = result(t, len(text), "symbols/s", matches=len(matched))
+
+    fn = os.path.join(tmp_dir, "%s.triedict" % name)
+    t, _ = timed(lambda: triedict.save(fn), repeat)
+    n_bytes = os.path.getsize(fn)
+    res["save"] = result(t, n_bytes / 2.0**20, "MB/s", bytes=n_bytes)
+    t, _ = timed(lambda: TrieDict.load(fn), repeat)
+    res["load"] = result(t, n_bytes / 2.0**20, "MB/s", bytes=n_bytes)
+
+    res["nodes"] = triedict.num_of_nodes()
+    res["buf_nodes"] = triedict.num_of_buf_nodes()
+    res["patterns"] = triedict.size()
+    # peak of the process of this corpus (see run_corpus())
+    res["peak_rss_kb"] = peak_rss_kb()
+    return res
+
+def run_corpus(name, args, tmp_dir):
+    """
+    Builds and benchmarks corpus [name]. This is
+    run in a fresh process for each corpus.
+    """
+    patterns, queries, text = make_corpus(name, args.n_patterns, args.text_length,
+                                          args.density, args.seed)
+    sys.stderr.write("%s: %d patterns, %d text symbols\n" % (name, len(patterns), len(text)))
+    return bench_corpus(name, patterns, queries, text, args.repeat, tmp_dir)
+
+def make_meta(args):
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "n_patterns": args.n_patterns,
+            "text_length": args.text_length,
+            "density": args.density,
+            "repeat": args.repeat}
+
+def run(args):
+    out = {"meta": make_meta(args),
+           "results": {}}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in args.corpus:
+            pool = multiprocessing.Pool(1)
+            try:
+                out["results"][name] = pool.apply(run_corpus, (name, args, tmp_dir))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return out
+
+def check_meta(meta, baseline_meta):
+    """
+    Raises a ValueError if the parameters of a run (see
+    COMPARED_META) differ from those of the baseline.
+    """
+    diff = ["%s=%s (baseline: %s)" % (key, meta.get(key), baseline_meta.get(key))
+            for key in COMPARED_META
+            if meta.get(key) != baseline_meta.get(key)]
+    if len(diff) > 0:
+        raise ValueError("baseline was run with other parameters: %s!" % ", ".join(diff))
+
+def compare(current, baseline, tolerance):
+    """
+    Compares the throughputs of [current] with [baseline].
+    Raises a ValueError if the runs used different
+    parameters (see COMPARED_META).
+
+    Returns:
+        A list of (corpus, benchmark, ratio, is_regression)
+        tuples; ratio = current / baseline throughput.
+    """
+    check_meta(current["meta"], baseline["meta"])
+    res = []
+    for name, benchs in sorted(current["results"].iteritems()):
+        base_benchs = baseline["results"].get(name, {})
+        for bench, values in sorted(benchs.iteritems()):
+            if not isinstance(values, dict) or not isinstance(base_benchs.get(bench), dict):
+                continue
+            ratio = values["throughput"] / base_benchs[bench]["throughput"]
+            res.append((name, bench, ratio, ratio < 1.0 - tolerance))
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TrieDict benchmarks")
+    parser.add_argument("--corpus", nargs="+", choices=CORPORA, default=CORPORA)
+    parser.add_argument("--n-patterns", type=int, default=20000)
+    parser.add_argument("--text-length", type=int, default=200000,
+                        help="number of symbols of the parsed text")
+    parser.add_argument("--density", type=float, default=0.2,
+                        help="fraction of the text tokens that are patterns")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs; the best time is reported")
+    parser.add_argument("--output", help="JSON result file (default: stdout)")
+    parser.add_argument("--baseline", help="JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown reported as regression")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        fp = open(args.baseline)
+        baseline = json.load(fp)
+        fp.close()
+        try:
+            check_meta(make_meta(args), baseline["meta"])
+        except ValueError, e:
+            sys.stderr.write("%s\n" % e)
+            return 2
+
+    out = run(args)
+    regressions = 0
+    if baseline is not None:
+        out["comparison"] = []
+        for name, bench, ratio, is_regression in compare(out, baseline, args.tolerance):
+            sys.stderr.write("%-10s %-22s %6.2fx%s\n" %
+                             (name, bench, ratio, "  REGRESSION" if is_regression else ""))
+            out["comparison"].append({"corpus": name, "benchmark": bench,
+                                      "ratio": ratio, "regression": is_regression})
+            regressions += is_regression
+
+    if args.output:
+        fp = open(args.output, "w")
+        json.dump(out, fp, indent=2, sort_keys=True)
+        fp.close()
+    else:
+        json.dump(out, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
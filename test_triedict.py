@@ -15,8 +15,16 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library.
 
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from triedict import TrieDict
+from ctypes import sizeof
+from triedict import TrieDict, ShardedTrieDict, PhraseTrieDict, build_normalization_table, \
+     LegacyHeader, Node
 
 class TestTrieDict(unittest.TestCase):
 
@@ -143,6 +151,594 @@ class TestTrieDict(unittest.TestCase):
         triedict.generate_suffix_links()
         matched = triedict.parse(s2)
 
+    def test_load_mmap(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "abd", "bc"]):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            triedict.save(fn)
+            triedict2 = TrieDict.load(fn, use_mmap=True)
+            self.assertEqual(triedict2.size(), 3)
+            self.assertEqual(triedict2.get("abd"), 1)
+            self.assertEqual(triedict2.parse("xabcx"), triedict.parse("xabcx"))
+            # modifications are not written to the file
+            triedict2.add_pattern("cde", 3)
+            self.assertEqual(triedict2.get("cde"), 3)
+            self.assertEqual(triedict2.get("abc"), 0)
+            self.assertIsNone(TrieDict.load(fn).get("cde"))
+        finally:
+            os.remove(fn)
+
+    def test_load_legacy(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "abd", "bc"]):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            # layout of the files written before the FileHeader
+            header = LegacyHeader(triedict.num_of_nodes(), triedict.size(), True)
+            fp = open(fn, "wb")
+            fp.write(header)
+            fp.write(buffer(triedict._data, 0, triedict.num_of_nodes()*sizeof(Node)))
+            fp.close()
+            for use_mmap in [False, True]:
+                triedict2 = TrieDict.load(fn, use_mmap)
+                self.assertEqual(triedict2.size(), 3)
+                self.assertEqual(triedict2.get("abd"), 1)
+                self.assertEqual(triedict2.parse("xabcx"), triedict.parse("xabcx"))
+            triedict2.save(fn)
+            self.assertEqual(TrieDict.load(fn).prefix_search("ab"), triedict.prefix_search("ab"))
+            fp = open(fn, "r+b")
+            fp.truncate(40)
+            fp.close()
+            self.assertRaises(ValueError, TrieDict.load, fn)
+            self.assertRaises(ValueError, TrieDict.load, fn, True)
+        finally:
+            os.remove(fn)
+
+    def test_snapshot(self):
+        triedict = TrieDict()
+        triedict.add_pattern("abc", 0)
+        snap = triedict.snapshot()
+        self.assertTrue(snap.is_snapshot())
+        for i in xrange(100):
+            triedict.add_pattern("x%d" % i, i)
+        triedict.add_pattern("abc", 7)
+        self.assertEqual(snap.size(), 1)
+        self.assertEqual(snap.get("abc"), 0)
+        self.assertIsNone(snap.get("x1"))
+        self.assertEqual(triedict.get("abc"), 7)
+        self.assertEqual(triedict.get("x99"), 99)
+        self.assertRaises(ValueError, snap.add_pattern, "abd", 1)
+
+    def test_watch(self):
+        triedict = TrieDict()
+        triedict.add_pattern("abc", 0)
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            triedict.save(fn)
+            handle = TrieDict.watch(fn, interval=0.01)
+            self.assertEqual(handle.get("abc"), 0)
+            old = handle.snapshot()
+            triedict.add_pattern("abd", 1)
+            triedict.save(fn)
+            for i in xrange(500):
+                if handle.get("abd") is not None:
+                    break
+                time.sleep(0.01)
+            handle.stop()
+            self.assertEqual(handle.get("abd"), 1)
+            self.assertIsNone(old.get("abd"))
+            # save() keeps the permissions and leaves no temporary file
+            self.assertEqual(os.stat(fn).st_mode & 0777, 0600)
+            tmp_prefix = os.path.basename(fn) + "."
+            self.assertEqual([f for f in os.listdir(os.path.dirname(fn))
+                              if f.startswith(tmp_prefix) and f.endswith(".tmp")], [])
+            # new files get the permissions of the current umask
+            os.remove(fn)
+            umask = os.umask(022)
+            try:
+                triedict.save(fn)
+            finally:
+                os.umask(umask)
+            self.assertEqual(os.stat(fn).st_mode & 0777, 0644)
+
+            # appended delta logs are picked up, too
+            triedict.generate_suffix_links(verbose=False)
+            triedict.save(fn)
+            handle = TrieDict.watch(fn, interval=0.01)
+            triedict.add_pattern("xyz", 2)
+            triedict.save_delta(fn)
+            for i in xrange(500):
+                if handle.get("xyz") is not None:
+                    break
+                time.sleep(0.01)
+            handle.stop()
+            self.assertEqual(handle.get("xyz"), 2)
+            self.assertEqual(handle.parse("axyz"), [("xyz", 2, 3)])
+        finally:
+            os.remove(fn)
+            if os.path.exists(fn + ".delta"):
+                os.remove(fn + ".delta")
+
+    def test_remove(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "ab", "b"]):
+            triedict.add_pattern(s, i)
+        self.assertEqual(triedict.size(), 3)
+        self.assertTrue(triedict.remove_pattern("ab"))
+        self.assertFalse(triedict.remove_pattern("ab"))
+        self.assertFalse(triedict.remove_pattern("xy"))
+        self.assertEqual(triedict.size(), 2)
+        self.assertIsNone(triedict.get("ab"))
+        self.assertEqual(triedict.get("abc"), 0)
+        self.assertEqual(triedict.prefix_search("a"), [("bc", 0)])
+        del triedict["b"]
+        self.assertRaises(ValueError, triedict.__delitem__, "b")
+        triedict.add_pattern("ab", 3)
+        self.assertEqual(triedict.size(), 2)
+
+    def test_delta(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "abd", "bcd"]):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        self.assertRaises(ValueError, triedict.save_delta, "x")
+        tmp_dir = tempfile.mkdtemp()
+        fn = os.path.join(tmp_dir, "dict")
+        try:
+            triedict.save(fn)
+            size = os.path.getsize(fn)
+            triedict.add_pattern("abe", 3)
+            triedict.add_pattern("abc", 4)
+            triedict.save_delta(fn)
+            triedict.remove_pattern("bcd")
+            triedict.save_delta(fn)
+            self.assertEqual(os.path.getsize(fn), size)
+
+            for use_mmap in [False, True]:
+                triedict2 = TrieDict.load(fn, use_mmap)
+                self.assertEqual(triedict2.size(), 3)
+                self.assertEqual(triedict2.get("abe"), 3)
+                self.assertEqual(triedict2.get("abc"), 4)
+                self.assertIsNone(triedict2.get("bcd"))
+                # "abe" added nodes, so the suffix pointers are stale
+                self.assertFalse(triedict2.has_suffix_pointers())
+                self.assertRaises(ValueError, triedict2.parse, "xabex")
+                triedict2.generate_suffix_links(verbose=False)
+                self.assertEqual(triedict2.parse("xabex"), [("abe", 3, 3)])
+
+            n_nodes = triedict2.num_of_nodes()
+            triedict2.checkpoint(fn)
+            self.assertFalse(os.path.exists(fn + ".delta"))
+            self.assertEqual(triedict2.num_of_nodes(), n_nodes - 3)
+            triedict3 = TrieDict.load(fn)
+            self.assertEqual(triedict3.size(), 3)
+            self.assertEqual(sorted(triedict3.prefix_search("ab")),
+                             [("c", 4), ("d", 1), ("e", 3)])
+            self.assertEqual(triedict3.parse("xabex"), [("abe", 3, 3)])
+
+            # updates and removals are replayed in place
+            triedict3.add_pattern("abe", 8)
+            triedict3.remove_pattern("abd")
+            triedict3.save_delta(fn)
+            triedict4 = TrieDict.load(fn, use_mmap=True)
+            self.assertTrue(triedict4.has_suffix_pointers())
+            self.assertTrue(triedict4._shared)
+            self.assertEqual(triedict4.size(), 2)
+            self.assertEqual(triedict4.parse("xabex abd"), [("abe", 8, 3)])
+            triedict3.add_pattern("abe", 3)
+            triedict3.add_pattern("abd", 1)
+            triedict3.save(fn)
+
+            # a log left over by a crash in save() is not replayed
+            triedict3.add_pattern("abc", 5)
+            triedict3.save_delta(fn)
+            shutil.copy(fn + ".delta", fn + ".old")
+            triedict3.add_pattern("abc", 6)
+            triedict3.save(fn)
+            os.rename(fn + ".old", fn + ".delta")
+            self.assertEqual(TrieDict.load(fn).get("abc"), 6)
+            triedict3.add_pattern("abe", 7)
+            triedict3.save_delta(fn)
+            triedict4 = TrieDict.load(fn)
+            self.assertEqual(triedict4.get("abc"), 6)
+            self.assertEqual(triedict4.get("abe"), 7)
+            self.assertRaises(ValueError, triedict4.save_delta, fn + "2")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_merge(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "abd"]):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        other = TrieDict()
+        for i, s in enumerate(["abd", "bc", "c"]):
+            other.add_pattern(s, i + 10)
+        triedict.merge(other)
+        self.assertEqual(triedict.size(), 4)
+        self.assertEqual(triedict.get("abc"), 0)
+        self.assertEqual(triedict.get("abd"), 10)
+        self.assertEqual(triedict.get("bc"), 11)
+        self.assertEqual(sorted(triedict.parse("abc")),
+                         [("abc", 0, 2), ("bc", 11, 2), ("c", 12, 2)])
+
+    def test_normalization(self):
+        triedict = TrieDict()
+        triedict.set_normalization(build_normalization_table())
+        self.assertTrue(triedict.has_normalization())
+        triedict.add_pattern(u"Caf\xe9", 0)
+        triedict.add_pattern(u"\xc9t\xe9", 1)
+        self.assertEqual(triedict.get(u"cafe"), 0)
+        self.assertEqual(triedict.get(u"CAF\xc9"), 0)
+        self.assertEqual(triedict.prefix_search(u"CA"), [(u"fe", 0)])
+        triedict.generate_suffix_links(verbose=False)
+        #    0         1
+        #    01234567890123
+        s = u"Un CAF\xc9, un \xe9T\xc9!"
+        matched = triedict.parse(s, bound_chars=u" ,!")
+        self.assertEqual(matched, [(u"cafe", 0, 6), (u"ete", 1, 14)])
+        self.assertEqual(s[6-3:6+1], u"CAF\xc9")
+
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            triedict.save(fn)
+            for use_mmap in [False, True]:
+                triedict2 = TrieDict.load(fn, use_mmap)
+                self.assertTrue(triedict2.has_normalization())
+                self.assertEqual(triedict2.get(u"\xe9t\xe9"), 1)
+                self.assertEqual(triedict2.parse(s, bound_chars=u" ,!"), matched)
+        finally:
+            os.remove(fn)
+        self.assertRaises(ValueError, triedict.set_normalization, {u"A": u"a"})
+
+    def test_stats_mode(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "bc", "c", "ax"]):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        self.assertIsNone(triedict.stats())
+        calls = []
+        triedict.enable_stats(lambda method, counters: calls.append((method, counters)))
+
+        s = "xabc abd"
+        matched = triedict.parse(s, bound_chars=" ")
+        self.assertEqual(matched, [])
+        counters = triedict.last_stats()
+        self.assertEqual(counters["calls"], 1)
+        self.assertEqual(counters["matches_emitted"], 0)
+        self.assertEqual(counters["matches_rejected_by_bounds"], 3)
+        self.assertEqual(counters["path_symbols"], 6)
+        self.assertEqual(counters["nodes_visited"], 5)
+        self.assertTrue(counters["suffix_hops"] > 0)
+        self.assertTrue(counters["sibling_comparisons"] > 0)
+        triedict.disable_stats()
+        self.assertIsNone(triedict.stats())
+        triedict.enable_stats()
+        self.assertEqual(triedict.parse(s), [("abc", 0, 3), ("bc", 1, 3), ("c", 2, 3)])
+
+        self.assertEqual(triedict.get("ax"), 3)
+        self.assertEqual(triedict.last_stats()["nodes_visited"], 2)
+        self.assertEqual(triedict.last_stats()["sibling_comparisons"], 3)
+        self.assertEqual(len(triedict.prefix_search("a")), 2)
+        self.assertEqual(triedict.stats()["calls"], 3)
+        self.assertEqual([method for method, c in calls], ["parse"])
+
+        self.assertEqual(triedict.children_histogram(), {0: 4, 1: 2, 2: 1, 3: 1})
+        self.assertEqual(triedict.suffix_chain_histogram(), {0: 1, 1: 4, 2: 2, 3: 1})
+        usage = triedict.memory_usage()
+        self.assertEqual(usage["used_nodes"], 8)
+        self.assertEqual(usage["buf_nodes"], triedict.num_of_buf_nodes())
+        triedict.reset_stats()
+        self.assertEqual(triedict.stats()["calls"], 0)
+
+    def test_stats_mode_equivalence(self):
+        # the instrumented methods must return the same results
+        rnd = random.Random(0)
+        for n in xrange(20):
+            triedict = TrieDict()
+            for i in xrange(rnd.randint(1, 30)):
+                triedict.add_pattern("".join([rnd.choice("abc ") for j in xrange(rnd.randint(1, 5))]), i)
+            triedict.generate_suffix_links(verbose=False)
+            texts = ["".join([rnd.choice("abcd ") for j in xrange(rnd.randint(0, 40))])
+                     for i in xrange(10)]
+            queries = [t[:rnd.randint(0, 5)] for t in texts]
+            for stats in [False, True]:
+                if stats:
+                    triedict.enable_stats()
+                res = ([triedict.parse(t) for t in texts],
+                       [triedict.parse(t, False, " ") for t in texts],
+                       [triedict.get(q) for q in queries],
+                       [sorted(triedict.prefix_search(q)) for q in queries])
+                if not stats:
+                    expected = res
+            self.assertEqual(res, expected)
+            self.assertEqual(triedict.stats()["calls"], 40)
+
+        # cache hits are counted, too
+        triedict.set_cache_size(10)
+        triedict.reset_stats()
+        triedict.get("ab")
+        triedict.get("ab")
+        triedict.prefix_search("a")
+        triedict.prefix_search("a")
+        self.assertEqual(triedict.stats()["calls"], 4)
+        self.assertEqual(triedict.stats()["cache_hits"], 2)
+        self.assertEqual(triedict.last_stats()["cache_hits"], 1)
+        self.assertEqual(triedict.last_stats()["nodes_visited"], 0)
+
+        # the plain methods are restored when everything is off
+        triedict.set_cache_size(0)
+        self.assertTrue("get" in triedict.__dict__)
+        triedict.disable_stats()
+        self.assertFalse("get" in triedict.__dict__)
+        self.assertFalse("prefix_search" in triedict.__dict__)
+        self.assertEqual(([triedict.get(q) for q in queries],
+                          [sorted(triedict.prefix_search(q)) for q in queries]),
+                         expected[2:])
+
+    def test_cache(self):
+        triedict = TrieDict()
+        for i, s in enumerate(["abc", "abd", "bcd"]):
+            triedict.add_pattern(s, i)
+        triedict.set_cache_size(3)
+        self.assertEqual(triedict.get("abc"), 0)
+        self.assertEqual(triedict.get("abc"), 0)
+        self.assertIsNone(triedict.get("ab"))
+        self.assertIsNone(triedict.get("ab"))
+        self.assertEqual(sorted(triedict.prefix_search("ab")), [("c", 0), ("d", 1)])
+        matched = triedict.prefix_search("ab")
+        matched.append(("x", 9)) # must not change the cached result
+        self.assertEqual(sorted(triedict.prefix_search("ab")), [("c", 0), ("d", 1)])
+        info = triedict.cache_info()
+        self.assertEqual((info["hits"], info["misses"], info["size"]), (4, 3, 3))
+
+        # invalidation
+        triedict.add_pattern("ab", 5)
+        triedict.add_pattern("bce", 6)
+        self.assertEqual(triedict.get("ab"), 5)
+        self.assertEqual(sorted(triedict.prefix_search("ab")),
+                         [("", 5), ("c", 0), ("d", 1)])
+        self.assertEqual(triedict.get("abc"), 0)
+
+        # eviction
+        for s in ["x", "y", "z"]:
+            triedict.get(s)
+        self.assertEqual(triedict.cache_info()["size"], 3)
+        misses = triedict.cache_info()["misses"]
+        triedict.get("abc")
+        self.assertEqual(triedict.cache_info()["misses"], misses + 1)
+
+        triedict.set_cache_size(0)
+        self.assertEqual(triedict.cache_info()["size"], 0)
+        self.assertEqual(triedict.get("abc"), 0)
+
+        # several threads querying a cached snapshot
+        for i in xrange(200):
+            triedict.add_pattern("p%d" % i, i)
+        snap = triedict.snapshot()
+        snap.set_cache_size(50)
+        errors = []
+        def query(seed):
+            try:
+                for i in xrange(2000):
+                    j = (i * seed) % 200
+                    if snap.get("p%d" % j) != j:
+                        errors.append(j)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=query, args=(seed,)) for seed in xrange(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(snap.cache_info()["size"], 50)
+
+    def _check_sharded(self, sharded, triedict):
+        self.assertEqual(sharded.size(), triedict.size())
+        for s in ["abc", "abd", "ab", "bcd", "x", "cd"]:
+            self.assertEqual(sharded.get(s), triedict.get(s))
+        for s in ["a", "ab", "b", "", "z"]:
+            self.assertEqual(sorted(sharded.prefix_search(s)),
+                             sorted(triedict.prefix_search(s)))
+        text = "xabcd abd bcd cdab"
+        matched = sharded.parse(text)
+        self.assertEqual([m[2] for m in matched], sorted(m[2] for m in matched))
+        self.assertEqual(sorted(matched), sorted(triedict.parse(text)))
+
+    def test_sharded(self):
+        patterns = ["c", "d", "abc", "abd", "bcd", "cd"]
+        triedict = TrieDict()
+        for i, s in enumerate(patterns):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        for partition in ["symbol", "hash"]:
+            sharded = ShardedTrieDict(3, partition)
+            for i, s in enumerate(patterns):
+                sharded.add_pattern(s, i)
+            sharded.generate_suffix_links(verbose=False)
+            self._check_sharded(sharded, triedict)
+
+            tmp_dir = tempfile.mkdtemp()
+            fn = os.path.join(tmp_dir, "sharded")
+            try:
+                sharded.save(fn)
+                self._check_sharded(ShardedTrieDict.load(fn), triedict)
+                sharded = ShardedTrieDict.load(fn, workers=True)
+                try:
+                    self._check_sharded(sharded, triedict)
+                    self.assertRaises(ValueError, sharded.add_pattern, "e", 1)
+                    # concurrent queries of several threads
+                    errors = []
+                    def query():
+                        try:
+                            for i in xrange(50):
+                                self._check_sharded(sharded, triedict)
+                        except Exception, e:
+                            errors.append(e)
+                    threads = [threading.Thread(target=query) for i in xrange(4)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    self.assertEqual(errors, [])
+                finally:
+                    sharded.close()
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    def test_phrase(self):
+        triedict = PhraseTrieDict()
+        triedict.add_pattern(u"new york", 0)
+        triedict.add_pattern(u"new york city", 1)
+        triedict.add_pattern(u"york", 2)
+        triedict.add_pattern(u"San  Jos\xe9", 3)
+        self.assertEqual(triedict.vocabulary_size(), 5)
+        self.assertEqual(triedict.get(u"new   york"), 0)
+        self.assertIsNone(triedict.get(u"new"))
+        self.assertIsNone(triedict.get(u"new jersey"))
+        self.assertEqual(sorted(triedict.prefix_search(u"new")),
+                         [(u"york", 0), (u"york city", 1)])
+        self.assertRaises(ValueError, triedict.add_pattern, u" ,")
+        # byte strings are rejected, not split within UTF-8 sequences
+        self.assertRaises(ValueError, triedict.add_pattern, "caf\xc3\xa9", 4)
+        self.assertRaises(ValueError, triedict.get, "new york")
+        self.assertRaises(ValueError, triedict.parse, "new york")
+        # an invalid patternID does not grow the vocabulary
+        self.assertRaises(ValueError, triedict.add_pattern, u"chicago", -1)
+        self.assertIsNone(triedict.token_id(u"chicago"))
+        self.assertEqual(triedict.vocabulary_size(), 5)
+        triedict.generate_suffix_links(verbose=False)
+        #    0         1         2         3
+        #    0123456789012345678901234567890123
+        s = u"in new york city, not newark; San Jos\xe9."
+        matched = triedict.parse(s)
+        self.assertEqual(matched, [(u"new york", 0, (1, 3), (3, 11)),
+                                   (u"york", 2, (2, 3), (7, 11)),
+                                   (u"new york city", 1, (1, 4), (3, 16)),
+                                   (u"San Jos\xe9", 3, (6, 8), (30, 38))])
+        self.assertEqual(s[3:16], u"new york city")
+        self.assertEqual(triedict.parse(s, join_patterns=False)[0][0], [u"new", u"york"])
+
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            triedict.save(fn)
+            for use_mmap in [False, True]:
+                triedict2 = PhraseTrieDict.load(fn, use_mmap)
+                self.assertEqual(triedict2.vocabulary_size(), 5)
+                self.assertEqual(triedict2.parse(s), matched)
+            # the vocabulary is read from the loaded version, even
+            # if the file is replaced while it is being loaded
+            other = PhraseTrieDict()
+            other.add_pattern(u"los angeles", 0)
+            read_extra = PhraseTrieDict._read_extra
+            def replacing_read_extra(self, fp):
+                other.save(fn)
+                read_extra(self, fp)
+            PhraseTrieDict._read_extra = replacing_read_extra
+            try:
+                triedict2 = PhraseTrieDict.load(fn)
+            finally:
+                PhraseTrieDict._read_extra = read_extra
+            self.assertEqual(triedict2.parse(s), matched)
+            self.assertEqual(PhraseTrieDict.load(fn).get(u"los angeles"), 0)
+            # a plain TrieDict file has no vocabulary
+            TrieDict().save(fn)
+            self.assertRaises(ValueError, PhraseTrieDict.load, fn)
+        finally:
+            os.remove(fn)
+
+        snap = triedict.snapshot()
+        self.assertTrue(triedict.remove_pattern(u"york"))
+        self.assertEqual(snap.get(u"york"), 2)
+        self.assertRaises(ValueError, snap.add_pattern, u"los angeles")
+        self.assertIsNone(snap.token_id(u"los"))
+        self.assertRaises(ValueError, snap.merge, triedict)
+
+        # the token IDs of merged dictionaries are translated
+        other = PhraseTrieDict()
+        other.add_pattern(u"los angeles", 4)
+        other.add_pattern(u"new york", 5)
+        triedict.merge(other)
+        self.assertEqual(triedict.get(u"los angeles"), 4)
+        self.assertEqual(triedict.get(u"new york"), 5)
+        self.assertEqual(triedict.get(u"new york city"), 1)
+        self.assertEqual(triedict.vocabulary_size(), 7)
+        # the snapshot does not see the tokens added after it
+        self.assertEqual(snap.vocabulary_size(), 5)
+        self.assertIsNone(snap.token_id(u"los"))
+        self.assertEqual(snap.token_id(u"york"), triedict.token_id(u"york"))
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            snap.save(fn)
+            self.assertEqual(PhraseTrieDict.load(fn).vocabulary_size(), 5)
+        finally:
+            os.remove(fn)
+        self.assertEqual([m[:2] for m in triedict.parse(u"Los angeles, new york")],
+                         [(u"new york", 5)])
+        self.assertRaises(ValueError, triedict.merge, TrieDict())
+
+        self.assertRaises(ValueError, triedict.parse, s, True, u" ")
+        self.assertRaises(ValueError, triedict.save_delta, "x")
+        self.assertRaises(ValueError, triedict.parse_many, [s])
+
+    def test_phrase_watch(self):
+        triedict = PhraseTrieDict()
+        triedict.add_pattern(u"new york", 0)
+        triedict.generate_suffix_links(verbose=False)
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            triedict.save(fn)
+            triedict.add_pattern(u"york city", 1)
+            self.assertIsNone(triedict._delta)
+            handle = PhraseTrieDict.watch(fn, interval=0.01)
+            handle.stop()
+            expected = [(u"new york", 0, (1, 3), (3, 11))]
+            self.assertEqual(handle.parse(u"in new york city"), expected)
+            self.assertEqual(handle.match(u"in new york city"), expected)
+            self.assertEqual(handle.get(u"new york"), 0)
+            self.assertIsNone(PhraseTrieDict.load(fn)._delta)
+        finally:
+            os.remove(fn)
+
+    def test_parse_many(self):
+        triedict = TrieDict()
+        patterns = ["this", "this is", "word", "dude", "s"]
+        for i, s in enumerate(patterns):
+            triedict.add_pattern(s, i)
+        triedict.generate_suffix_links(verbose=False)
+        docs = ["this word...has words dudes, or dude!", "",
+                "this is this is", "dude"]
+        expected = []
+        for i, s in enumerate(docs):
+            expected.extend([(i,) + m for m in triedict.parse(s, bound_chars=" !.,")])
+        for chunk_size in [1, 3, 7, 100]:
+            matched = list(triedict.parse_many(docs, workers=2, bound_chars=" !.,",
+                                               chunk_size=chunk_size))
+            self.assertEqual(sorted(matched), sorted(expected))
+        matched = list(triedict.parse_many(docs, bound_chars=" !.,"))
+        self.assertEqual(matched, expected)
+
+        # small documents are batched into one task
+        batches = list(TrieDict._split_documents(docs, 100, 7))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([task[0] for task in batches[0]], [0, 2, 3])
+        batches = list(TrieDict._split_documents(docs, 10, 7))
+        self.assertTrue(all([sum([t[4] - t[3] for t in batch]) <= 10 for batch in batches]))
+        self.assertEqual(triedict._max_pattern_length(), 7)
+
     # SWITCHED OFF ##################################
 
     def _test_generate_suffix_pointers(self):
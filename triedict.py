@@ -62,22 +62,110 @@ and values will follow.
 see README.md
 """
 
+import os
+import re
+import errno
 import sys
-from ctypes import Structure, c_uint32, c_bool, sizeof, \
-     POINTER, resize, memset, create_string_buffer, byref
-from collections import deque
+import time
+import mmap
+import stat
+import random
+import zlib
+import unicodedata
+import tempfile
+import threading
+import multiprocessing
+from ctypes import Structure, c_uint32, c_bool, c_char, sizeof, \
+     POINTER, resize, memset, memmove, create_string_buffer, byref
+from array import array
+from collections import deque, OrderedDict
 
 DEF_BOUND_CHARS = " !?=-*+#:;,.'\"()&%$"
 
+# marks a query that is not in the result cache
+_NOT_CACHED = object()
+
+# counters of the stats mode (see TrieDict#enable_stats())
+STATS_COUNTERS = ["calls",
+                  "nodes_visited",
+                  "sibling_comparisons",
+                  "suffix_hops",
+                  "output_hops",
+                  "path_symbols",
+                  "matches_emitted",
+                  "matches_rejected_by_bounds",
+                  "cache_hits",
+                  "seconds"]
+
+# identifies (and versions) the file format; files
+# without it have the legacy layout (see LegacyHeader)
+FILE_MAGIC = "TDIC"
+FILE_VERSION = 1
+
+class FileHeader(Structure):
+    """
+    First bytes of a serialized Trie. It is followed
+    by the Header, the nodes and the normalization table.
+    """
+    _fields_ = [("magic", c_char * 4),
+                ("version", c_uint32)]
+
+class LegacyHeader(Structure):
+    """
+    Header of the files written before the FileHeader
+    was introduced. It is followed by the nodes.
+    """
+    _fields_ = [("n_nodes", c_uint32),
+                ("n_patterns", c_uint32),
+                ("has_suffix_pointers", c_bool)]
+
 class Header(Structure):
     """
     Holds essential dictionary information.
-    This is stored as the first bytes of the
+    This is stored after the FileHeader of the
     serialized Trie.
     """
     _fields_ = [("n_nodes", c_uint32),
                 ("n_patterns", c_uint32),
-                ("has_suffix_pointers", c_bool)]
+                ("has_suffix_pointers", c_bool),
+                ("n_norm_symbols", c_uint32),
+                ("generation", c_uint32)]
+
+class ShardHeader(Structure):
+    """
+    Describes a sharded dictionary. This is stored
+    in the manifest file of a ShardedTrieDict.
+    """
+    _fields_ = [("n_shards", c_uint32),
+                ("partition", c_uint32)]
+
+class DeltaLogHeader(Structure):
+    """
+    First bytes of the delta log of a dictionary. The log
+    only applies to the saved dictionary of the same
+    generation (see TrieDict#save()).
+    """
+    _fields_ = [("generation", c_uint32)]
+
+class DeltaRecord(Structure):
+    """
+    Header of a record in the delta log of a dictionary
+    (see TrieDict#save_delta()). It is followed by [length]
+    uint32 encoded symbols of the pattern.
+    """
+    _fields_ = [("op", c_uint32),
+                ("value", c_uint32),
+                ("length", c_uint32)]
+
+class VocabularyHeader(Structure):
+    """
+    Header of the token vocabulary of a PhraseTrieDict.
+    It is followed by the UTF-8 encoded token pattern, the
+    uint32 byte lengths of the tokens and the UTF-8 encoded
+    tokens.
+    """
+    _fields_ = [("n_tokens", c_uint32),
+                ("token_pattern_len", c_uint32)]
 
 class Node(Structure):
     """
@@ -116,6 +204,13 @@ class TrieDict(object):
     _P = POINTER(Node)
     _MAX_PATTERN_ID = 2**32-2
 
+    # operations of the delta log
+    _DELTA_SET = 1
+    _DELTA_REMOVE = 2
+
+    # joins the decoded symbols of a pattern (join_patterns=True)
+    _JOIN_SEPARATOR = ""
+
     def __init__(self, init_n=1, symbol_encoder=None, symbol_decoder=None):
         """
         Constructs a new dictionary.
@@ -149,43 +244,333 @@ class TrieDict(object):
         # number of nodes fitting in memory
         self._buf_nodes = init_n
 
+        # True, if the node array is not owned by this object
+        # (e.g., a memory-mapped file). It is copied to a private
+        # array before the first modification.
+        self._shared = False
+        self._mmap = None
+
+        # True for read-only snapshots (see #snapshot())
+        self._frozen = False
+
+        # True if #load() invalidated the suffix pointers
+        # while replaying the delta log
+        self._suffix_pointers_dropped = False
+
+        # file holding the current state of the dictionary, or None
+        # if the dictionary has been modified since #load() or #save().
+        self._fn = None
+
+        # normalization table: array of folded encoded symbols
+        # indexed by the encoded symbol (see #set_normalization())
+        self._norm = None
+
+        # upper bound of the pattern length, or None if it has not
+        # been computed yet (see #_max_pattern_length())
+        self._max_depth = 0
+
+        # (op, codes, value) modifications since the last full
+        # #save() or #load() of file _base_fn, or None if they
+        # are not tracked (see #save_delta())
+        self._delta = None
+        self._base_fn = None
+
+        # LRU cache of query results (see #set_cache_size()); it
+        # is guarded by _cache_lock, since snapshots are queried
+        # by several threads
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._cache_size = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+        # cumulative counters of the stats mode, or None if
+        # the stats mode is off (see #enable_stats())
+        self._stats = None
+        self._last_stats = None
+        self._stats_hooks = []
+
     # INTERFACE ///////////////////////////////////////////////////////////
 
-    @staticmethod
-    def load(fn):
+    @classmethod
+    def load(cls, fn, use_mmap=False):
         """
-        Loads the dictionary from disc.
+        Loads the dictionary from disc and replays
+        its delta log (see #save_delta()), if any.
+
+        Records that update or remove patterns are replayed in
+        place. Records that add new nodes make the node array
+        private (see use_mmap) and invalidate the suffix pointers,
+        since regenerating them takes time linear in the size of
+        the Trie: #has_suffix_pointers() is False then, and
+        #generate_suffix_links() needs to be called before
+        #parse(). Use #checkpoint() to fold the log into the file.
 
         Args:
             fn: The filename of the file.
+            use_mmap: If True, the node array is memory-mapped
+              instead of being read into memory. The pages of the
+              file are then shared by all processes mapping the
+              same file. The mapping is copied into memory on the
+              first modification of the dictionary (only the
+              modified pages are copied while a delta log is
+              replayed).
         """
+        triedict = cls(1)
         fp = open(fn, "rb")
-        header = Header()
-        fp.readinto(header)
-        data = create_string_buffer(header.n_nodes*sizeof(Node))
-        fp.readinto(data)
-        fp.close()
+        try:
+            header, nodes_start = TrieDict._read_header(fp)
+            mm = None
+            if use_mmap:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+                norm_start = nodes_start + header.n_nodes*sizeof(Node)
+                if len(mm) < norm_start:
+                    raise ValueError("truncated file!")
+                data = (Node * header.n_nodes).from_buffer(mm, nodes_start)
+                norm_bytes = mm[norm_start:norm_start + header.n_norm_symbols*4]
+            else:
+                data = create_string_buffer(header.n_nodes*sizeof(Node))
+                if fp.readinto(data) != sizeof(data):
+                    raise ValueError("truncated file!")
+                norm_bytes = fp.read(header.n_norm_symbols*4)
+            if len(norm_bytes) != header.n_norm_symbols*4:
+                raise ValueError("truncated file!")
+            # read from the same file, which a concurrent
+            # #save() may already have replaced by a new version
+            fp.seek(nodes_start + header.n_nodes*sizeof(Node) +
+                    header.n_norm_symbols*4)
+            triedict._read_extra(fp)
+        finally:
+            fp.close()
 
-        triedict = TrieDict(1)
         triedict._header = header
         triedict._data = data
         triedict._p = TrieDict._P(triedict._data)
         triedict._buf_nodes = triedict._header.n_nodes
+        triedict._shared = use_mmap
+        triedict._mmap = mm
+        triedict._max_depth = None
+        if header.n_norm_symbols > 0:
+            triedict._norm = array("I")
+            triedict._norm.fromstring(norm_bytes)
+            triedict._update_query_methods()
+
+        if os.path.exists(TrieDict._delta_fn(fn)):
+            triedict._replay_delta(TrieDict._delta_fn(fn))
+        triedict._fn = fn
+        triedict._delta = []
+        triedict._base_fn = fn
 
         return triedict
 
+    @classmethod
+    def watch(cls, fn, interval=1.0, use_mmap=False):
+        """
+        Loads the dictionary from file [fn] and reloads it
+        in a background thread whenever the file is replaced
+        (e.g., by #save()).
+
+        Args:
+            fn: The filename of the file.
+            interval: Seconds between two checks of the file.
+            use_mmap: see #load(). Only safe if the file is always
+              replaced by a rename (as done by #save()): the pages of
+              a mapped file that is overwritten in place change under
+              the readers of the current version, and reading a
+              truncated mapping crashes the process (SIGBUS).
+
+        Returns:
+            A TrieDictHandle that always refers to the
+            latest loaded version of the dictionary.
+        """
+        handle = TrieDictHandle()
+        handle.watch(fn, interval, use_mmap, cls)
+        return handle
+
     def save(self, fn):
         """
         Serializes the dictionary to file [fn].
+        The dictionary is written to a temporary file first,
+        which then replaces [fn]. Hence, readers of [fn] never
+        see a partially written dictionary.
 
         Args:
             fn: The filename of the file.
         """
-        resize(self._data, self._header.n_nodes * sizeof(Node))
-        fp = open(fn, "wb")
-        fp.write(self._header)
-        fp.write(self._data)
+        # The delta log of the previous version is obsolete: its
+        # records may be older than the saved patterns. Each save
+        # gets a new generation, such that a log that is left over
+        # (e.g., after a crash before its removal) is ignored.
+        generation = self._header.generation
+        while self._header.generation == generation:
+            self._header.generation = random.getrandbits(32)
+        try:
+            self._write(fn)
+        except:
+            self._header.generation = generation
+            raise
+        if os.path.exists(TrieDict._delta_fn(fn)):
+            os.remove(TrieDict._delta_fn(fn))
+        self._fn = fn
+        self._delta = []
+        self._base_fn = fn
+
+    def save_delta(self, fn):
+        """
+        Appends the patterns that have been added, updated or
+        removed since the last #save(fn) or #load(fn) to the delta
+        log of file [fn] ([fn].delta). This is much cheaper than
+        rewriting the whole dictionary with #save(). The log is
+        replayed by #load(fn) and folded into the file by
+        #checkpoint(fn).
+
+        Args:
+            fn: The filename of the dictionary file. This must be
+              the file of the last #save() or #load().
+        """
+        if self._delta is None:
+            raise ValueError("dictionary has not been saved or loaded yet, use save()!")
+        if os.path.abspath(fn) != os.path.abspath(self._base_fn):
+            raise ValueError("dictionary was not saved to or loaded from %s, use save()!" % fn)
+        delta_fn = TrieDict._delta_fn(fn)
+        if TrieDict._delta_generation(delta_fn) == self._header.generation:
+            fp = open(delta_fn, "ab")
+        else:
+            # start a new log (replacing an obsolete one)
+            fp = open(delta_fn, "wb")
+            log_header = DeltaLogHeader()
+            log_header.generation = self._header.generation
+            fp.write(log_header)
+        for op, codes, value in self._delta:
+            record = DeltaRecord()
+            record.op = op
+            record.value = value
+            record.length = len(codes)
+            fp.write(record)
+            fp.write(array("I", codes).tostring())
         fp.close()
+        self._delta = []
+        self._fn = fn
+
+    def checkpoint(self, fn):
+        """
+        Compacts the dictionary (drops the nodes of removed patterns)
+        and saves it as the new version of file [fn]. The delta
+        log of [fn] is removed.
+
+        Args:
+            fn: The filename of the dictionary file.
+        """
+        self._prepare_write()
+        compacted = TrieDict(max(self._header.n_nodes, 1),
+                             self._symbol_encoder, self._symbol_decoder)
+        compacted._header.n_norm_symbols = self._header.n_norm_symbols
+        for codes, value in self._iter_patterns():
+            compacted._insert(codes, value)
+        if (self._header.has_suffix_pointers or self._suffix_pointers_dropped) and \
+                compacted.size() > 0:
+            compacted.generate_suffix_links(verbose=False)
+        self._header = compacted._header
+        self._data = compacted._data
+        self._p = compacted._p
+        self._buf_nodes = compacted._buf_nodes
+        self._max_depth = compacted._max_depth
+        self.save(fn)
+
+    def merge(self, other):
+        """
+        Adds all patterns of the dictionary [other] (that uses
+        the same symbol encoding) to this dictionary. Patterns
+        stored in both dictionaries get the value of [other].
+        The suffix pointers are regenerated if they existed.
+        """
+        self._prepare_write()
+        for codes, value in other._iter_patterns():
+            codes = self._merged_codes(other, codes)
+            self._insert(codes, value)
+            if self._delta is not None:
+                self._delta.append((TrieDict._DELTA_SET, codes, value))
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache.clear()
+        if self._header.has_suffix_pointers and self.size() > 0:
+            self.generate_suffix_links(verbose=False)
+
+    def snapshot(self):
+        """
+        Returns a read-only view of the current state of the
+        dictionary. The view shares the node array with this
+        dictionary (copy-on-write): the next modification of this
+        dictionary works on a copy of the array. Hence, the snapshot
+        can be queried by other threads while this dictionary is
+        being modified.
+        """
+        if self._frozen:
+            return self
+        snap = self._new_snapshot()
+        snap._header = Header.from_buffer_copy(self._header)
+        snap._data = self._data
+        snap._p = self._p
+        snap._buf_nodes = self._buf_nodes
+        snap._shared = True
+        snap._mmap = self._mmap
+        snap._norm = self._norm
+        snap._update_query_methods()
+        snap._max_depth = self._max_depth
+        snap._fn = self._fn
+        snap._frozen = True
+        self._shared = True
+        return snap
+
+    def is_snapshot(self):
+        """
+        Returns True if this is a read-only snapshot
+        (see #snapshot()).
+        """
+        return self._frozen
+
+    def set_normalization(self, table):
+        """
+        Sets a normalization table that maps symbols to their
+        normalized (e.g., case-folded) symbols. It is applied to
+        each symbol of the patterns given to #add_pattern(), #get(),
+        #prefix_search() and #parse(), such that e.g. a case-folded
+        dictionary matches text of any case. Since one symbol is
+        mapped to one symbol, the match positions of #parse() refer
+        to the original text. The table is saved with the dictionary.
+
+        The table needs to be set before the first pattern is added.
+        See build_normalization_table() for case folding and accent
+        stripping.
+
+        Args:
+            table: A dict <symbol> -> <symbol>, or None to
+              remove the table.
+        """
+        if self._header.n_nodes > 1:
+            raise ValueError("normalization must be set before adding patterns!")
+        self._prepare_write()
+        if not table:
+            self._norm = None
+            self._header.n_norm_symbols = 0
+            self._update_query_methods()
+            return
+        codes = dict((self._symbol_encoder(symbol), self._symbol_encoder(norm_symbol))
+                     for symbol, norm_symbol in table.iteritems())
+        self._norm = array("I", xrange(max(codes) + 1))
+        for c, norm_c in codes.iteritems():
+            if norm_c == 0:
+                raise ValueError("encoded symbol should not have value 0!")
+            self._norm[c] = norm_c
+        self._header.n_norm_symbols = len(self._norm)
+        self._update_query_methods()
+
+    def has_normalization(self):
+        """
+        Returns True if a normalization table is set
+        (see #set_normalization()).
+        """
+        return self._norm is not None
 
     def has_suffix_pointers(self):
         """
@@ -241,56 +626,33 @@ class TrieDict(object):
         if (patternID < 0) or (patternID > TrieDict._MAX_PATTERN_ID):
             raise ValueError("patternID must be in range [0,2**32-2]!")
 
-        patternID += 1
+        self._prepare_write()
+        codes = self._encode_pattern(s)
+        self._insert(codes, patternID + 1)
+        if self._delta is not None:
+            self._delta.append((TrieDict._DELTA_SET, codes, patternID + 1))
+        if self._cache is not None:
+            self._invalidate_cache(codes)
 
-        ni = 0
-        nd = self._getnode(ni) # current node object (root)
-
-        new_pattern = False
-        for symbol in s:
-            c = self._symbol_encoder(symbol)
-            if c == 0:
-                raise ValueError("encoded symbol should not have value 0!")
-            if nd.p_child == 0:
-                # Node has no child yet;
-                # create new child node
-                nni, nnd = self._create_new_node(c, ni)
-                new_pattern = True
-                # The pointer _p might have changed
-                # when the array was increased (since the increase
-                # can move the arrays' memory block).
-                # Since the nodes are aware of the pointer
-                # by which they have been retrieved,
-                # we need to get the node once again after a
-                # create_new_node() call.
-                nd = self._getnode(ni)
+    def remove_pattern(self, s):
+        """
+        Removes the pattern s from the dictionary.
+        The nodes of the pattern are kept until the
+        next #checkpoint().
 
-                # now make the new node the current node
-                nd.p_child = nni
-                nd = nnd
-                ni = nni
-                continue
-            else:
-                # follow the linked list starting with
-                # the child to find matching node
-                parent_ni = ni
-                ni = nd.p_child
-                nd = self._getnode(ni)
-                while nd.p_brother != 0 and nd.symbol != c:
-                    ni = nd.p_brother
-                    nd = self._getnode(ni)
-                if nd.symbol != c:
-                    # no matching node has been found;
-                    # create new brother node
-                    nni, nnd = self._create_new_node(c, parent_ni)
-                    new_pattern = True
-                    nd = self._getnode(ni)
-                    nd.p_brother = nni
-                    nd = nnd
-                    ni = nni
-        nd.value = patternID
-        if new_pattern:
-            self._header.n_patterns += 1
+        Returns:
+            True, if the pattern was stored in the
+            dictionary, else, False.
+        """
+        self._prepare_write()
+        codes = self._encode_pattern(s)
+        if not self._remove(codes):
+            return False
+        if self._delta is not None:
+            self._delta.append((TrieDict._DELTA_REMOVE, codes, 0))
+        if self._cache is not None:
+            self._invalidate_cache(codes)
+        return True
 
     def lookup(self, s):
         """
@@ -305,6 +667,8 @@ class TrieDict(object):
         in the dictionary.
         """
 
+        # Plain lookup; replaced by #_get_dispatched() while the
+        # cache or the stats mode is on (see #_update_query_methods()).
         ni = self._get_pattern_node(s)
         if ni != 0:
             nd = self._p[ni]
@@ -327,14 +691,82 @@ class TrieDict(object):
             A list of (suffix-sequence, value) tuples.
         """
 
-        ni = self._get_pattern_node(prefix)
+        # Plain search; replaced by #_prefix_search_dispatched() while
+        # the cache or the stats mode is on.
         res = []
+        ni = self._get_pattern_node(prefix)
         if ni != 0:
             self._collect_subtree_links(ni, res)
-
         self._decode_pattern_result(res, join_patterns)
         return res
 
+    def _get_dispatched(self, s):
+        """
+        #get() using the cache and/or the stats mode.
+        """
+        if self._cache is not None:
+            t0 = time.time() if self._stats is not None else 0
+            key = ("get", self._encode_pattern(s))
+            value = self._cache_lookup(key)
+            if value is _NOT_CACHED:
+                value = self._get_value(s)
+                self._cache_store(key, value)
+            elif self._stats is not None:
+                self._record_cache_hit("get", 1 if value is not None else 0, t0)
+            return value
+        return self._get_value(s)
+
+    def _prefix_search_dispatched(self, prefix, join_patterns=True):
+        """
+        #prefix_search() using the cache and/or the stats mode.
+        """
+        if self._cache is not None:
+            t0 = time.time() if self._stats is not None else 0
+            key = ("prefix_search", self._encode_pattern(prefix), join_patterns)
+            res = self._cache_lookup(key)
+            if res is _NOT_CACHED:
+                res = self._prefix_search(prefix, join_patterns)
+                self._cache_store(key, res)
+            elif self._stats is not None:
+                self._record_cache_hit("prefix_search", len(res), t0)
+            # the cached list must not be changed by the caller
+            if join_patterns:
+                return list(res)
+            return [(list(suffix), value) for suffix, value in res]
+        return self._prefix_search(prefix, join_patterns)
+
+    def set_cache_size(self, max_entries):
+        """
+        Enables a LRU cache for the results of #get() and
+        #prefix_search() holding up to [max_entries] results.
+        Cached results of a prefix are dropped when a pattern
+        starting with this prefix is added. A size of 0 disables
+        the cache. The cache can be used by several threads.
+        """
+        if max_entries < 0:
+            raise ValueError("max_entries must not be negative!")
+        with self._cache_lock:
+            self._cache_size = max_entries
+            if max_entries == 0:
+                self._cache = None
+            else:
+                if self._cache is None:
+                    self._cache = OrderedDict()
+                while len(self._cache) > max_entries:
+                    self._cache.popitem(last=False)
+        self._update_query_methods()
+
+    def cache_info(self):
+        """
+        Returns a dict with the number of cache hits and
+        misses, and the current and maximum number of
+        cached results.
+        """
+        return {"hits": self._cache_hits,
+                "misses": self._cache_misses,
+                "size": len(self._cache) if self._cache is not None else 0,
+                "max_size": self._cache_size}
+
     def match(self, s, join_patterns=True, bound_chars=None):
         return self.parse(s, join_patterns, bound_chars)
 
@@ -353,14 +785,22 @@ class TrieDict(object):
 
         if not self._header.has_suffix_pointers:
             raise ValueError("Trie has no suffix pointers!")
+        if self._stats is not None:
+            return self._parse_with_stats(s, join_patterns, bound_chars)
 
+        # Changes of this loop need to be applied to
+        # #_parse_with_stats(), too (see test_stats_mode_equivalence).
         matched = []
         ni = 0
         nd = self._p[ni]
         pos = 0
         m = len(s)
+        norm = self._norm
+        n_norm = len(norm) if norm is not None else 0
         while pos < m:
             c = self._symbol_encoder(s[pos])
+            if c < n_norm:
+                c = norm[c]
 
             child_ni, child_nd = self._get_matching_child(nd, c)
 
@@ -389,6 +829,176 @@ class TrieDict(object):
             TrieDict._remove_matches_without_bounds(s, matched, bound_chars)
         return matched
 
+    def parse_many(self, documents, workers=1, join_patterns=True,
+                   bound_chars=None, chunk_size=2**20):
+        """
+        Finds all stored patterns that occur in the documents
+        using a pool of [workers] processes.
+
+        The workers memory-map the same saved dictionary file,
+        such that the Trie is held only once in memory. If the
+        dictionary has not been saved (or was modified since), it
+        is written to a temporary file first. Large documents are
+        split into chunks of [chunk_size] symbols that overlap by
+        the maximum pattern length, such that no match on a chunk
+        boundary is lost or reported twice.
+
+        Custom symbol en/de-coders need to be picklable (e.g.,
+        module-level functions) to be used with workers > 1.
+
+        Args:
+            documents: An iterable of strings or sequence-like objects.
+            workers: Number of worker processes. If workers <= 1,
+              the documents are parsed in the current process.
+            chunk_size: Maximum number of symbols parsed by a worker
+              in one task.
+
+        Returns:
+            An iterator over (docIdx, pattern, value, pos) tuples,
+            ordered by docIdx and chunk.
+        """
+
+        if not self._header.has_suffix_pointers:
+            raise ValueError("Trie has no suffix pointers!")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive!")
+
+        if workers <= 1:
+            return self._parse_many_serial(documents, join_patterns, bound_chars)
+        return self._parse_many_parallel(documents, workers, join_patterns,
+                                         bound_chars, chunk_size)
+
+    def enable_stats(self, hook=None):
+        """
+        Turns on the stats mode: #get(), #prefix_search() and
+        #parse() count their traversal steps (see STATS_COUNTERS)
+        per call and cumulatively. The counters describe:
+        * nodes_visited: nodes entered along the Trie paths
+        * sibling_comparisons: child nodes compared while scanning
+          the brother lists
+        * suffix_hops: suffix pointers followed after a mismatch
+        * output_hops: suffix pointers followed to report the
+          patterns ending at a position
+        * path_symbols: symbols of the reconstructed match paths
+        * matches_emitted: matches (or prefix search results) found
+        * matches_rejected_by_bounds: matches removed by bound_chars
+        * cache_hits: calls answered by the result cache (see
+          #set_cache_size()) without traversing the Trie
+        * seconds: time spent in the calls
+
+        The stats mode uses separate instrumented methods, so it
+        does not slow down the dictionary while it is off.
+
+        Args:
+            hook: An optional function (method, counters) -> None
+              called after each instrumented call with the name of
+              the method and the counters of the call (e.g., to
+              export metrics). See also #add_stats_hook().
+        """
+        if self._stats is None:
+            self._stats = TrieDict._new_counters()
+        if hook is not None:
+            self.add_stats_hook(hook)
+        self._update_query_methods()
+
+    def disable_stats(self):
+        """
+        Turns off the stats mode and removes the stats hooks.
+        """
+        self._stats = None
+        self._last_stats = None
+        self._stats_hooks = []
+        self._update_query_methods()
+
+    def add_stats_hook(self, hook):
+        """
+        Adds a function (method, counters) -> None that is called
+        after each call instrumented by the stats mode.
+        """
+        self._stats_hooks.append(hook)
+
+    def stats(self):
+        """
+        Returns a dict with the cumulative counters of
+        the stats mode, or None if it is off.
+        """
+        if self._stats is None:
+            return None
+        return dict(self._stats)
+
+    def last_stats(self):
+        """
+        Returns a dict with the counters of the last
+        instrumented call, or None.
+        """
+        if self._last_stats is None:
+            return None
+        return dict(self._last_stats)
+
+    def reset_stats(self):
+        """
+        Sets the cumulative counters of the stats mode to 0.
+        """
+        if self._stats is not None:
+            self._stats = TrieDict._new_counters()
+        self._last_stats = None
+
+    def children_histogram(self):
+        """
+        Returns a dict <number of children> -> <number of nodes>.
+        """
+        hist = {}
+        for ni in xrange(self._header.n_nodes):
+            n_children = 0
+            child_ni = self._p[ni].p_child
+            while child_ni != 0:
+                n_children += 1
+                child_ni = self._p[child_ni].p_brother
+            hist[n_children] = hist.get(n_children, 0) + 1
+        return hist
+
+    def suffix_chain_histogram(self):
+        """
+        Returns a dict <suffix chain length> -> <number of nodes>,
+        where the suffix chain length of a node is the number of
+        suffix pointers followed to reach the root.
+        """
+        if not self._header.has_suffix_pointers:
+            raise ValueError("Trie has no suffix pointers!")
+        n_nodes = self._header.n_nodes
+        lengths = [-1] * n_nodes
+        lengths[0] = 0
+        hist = {0: 1}
+        for ni in xrange(1, n_nodes):
+            # follow the chain until a node of known length
+            chain = []
+            suffix_ni = ni
+            while lengths[suffix_ni] < 0:
+                chain.append(suffix_ni)
+                suffix_ni = self._p[suffix_ni].p_suffix
+            length = lengths[suffix_ni]
+            for chain_ni in reversed(chain):
+                length += 1
+                lengths[chain_ni] = length
+                hist[length] = hist.get(length, 0) + 1
+        return hist
+
+    def memory_usage(self):
+        """
+        Returns a dict with the memory usage of the
+        dictionary in bytes and nodes.
+        """
+        n_nodes = self._header.n_nodes
+        return {"node_size": sizeof(Node),
+                "used_nodes": n_nodes,
+                "buf_nodes": self._buf_nodes,
+                "free_nodes": self._buf_nodes - n_nodes,
+                "used_bytes": n_nodes * sizeof(Node),
+                "buf_bytes": self._buf_nodes * sizeof(Node),
+                "norm_bytes": len(self._norm) * 4 if self._norm is not None else 0,
+                "shared": self._shared,
+                "cache_entries": len(self._cache) if self._cache is not None else 0}
+
     def generate_suffix_pointers(self, verbose=True):
         self.generate_suffix_links(verbose)
 
@@ -402,6 +1012,9 @@ class TrieDict(object):
         if nd.p_child == 0:
             raise ValueError("empty trie!")
 
+        self._prepare_write()
+        nd = self._p[0]
+
         # fill queue with roots' child nodes
         queue = deque()
         child_ni = nd.p_child
@@ -465,6 +1078,7 @@ class TrieDict(object):
         if verbose:
             sys.stderr.write("\n")
         self._header.has_suffix_pointers = True
+        self._suffix_pointers_dropped = False
 
     # OBJECT OVERWRITES /////////////////////////////////////////////////////////
 
@@ -479,7 +1093,8 @@ class TrieDict(object):
                (self.size(), self.num_of_nodes(), self.num_of_buf_nodes(), self.has_suffix_pointers())
 
     def __delitem__(self, key):
-        raise NotImplementedError("del not supported")
+        if not self.remove_pattern(key):
+            raise ValueError("key not in dictionary")
 
     def __setitem__(self, key, value):
         self.add_pattern(key, value)
@@ -528,6 +1143,25 @@ class TrieDict(object):
         #print path, nd_start
         return path
 
+    def _update_query_methods(self):
+        """
+        Binds #get(), #prefix_search() and #_get_pattern_node() to
+        the variants needed by the cache, the stats mode and the
+        normalization table, such that a plain lookup does not pay
+        for them while they are off.
+        """
+        dispatched = self._cache is not None or self._stats is not None
+        for name, method in [("get", self._get_dispatched),
+                             ("prefix_search", self._prefix_search_dispatched)]:
+            if dispatched:
+                self.__dict__[name] = method
+            else:
+                self.__dict__.pop(name, None)
+        if self._norm is not None:
+            self._get_pattern_node = self._get_normalized_pattern_node
+        else:
+            self.__dict__.pop("_get_pattern_node", None)
+
     def _get_pattern_node(self, s):
         """
         Returns the nodeIdx of the node
@@ -550,64 +1184,553 @@ class TrieDict(object):
                 return 0
         return ni
 
-    def _get_matching_child(self, nd, symbol):
+    def _get_normalized_pattern_node(self, s):
         """
-        Returns a (nodeIdx, node) tuple of
-        that child node of [nd], that matches
-        [symbol], otherwise (None, None).
+        #_get_pattern_node() applying the normalization table.
         """
-        child_ni = nd.p_child
-        while child_ni != 0:
-            child_nd = self._p[child_ni]
-            if child_nd.symbol == symbol:
-                return child_ni, child_nd
-            child_ni = child_nd.p_brother
-        return None, None
+        ni = 0
+        nd = self._p[ni]
+        norm = self._norm
+        n_norm = len(norm)
+        for symbol in s:
+            c = self._symbol_encoder(symbol)
+            if c < n_norm:
+                c = norm[c]
+            if nd.p_child != 0:
+                ni = nd.p_child
+                nd = self._p[ni]
+                while nd.p_brother != 0 and nd.symbol != c:
+                    ni = nd.p_brother
+                    nd = self._p[ni]
+                if nd.symbol != c:
+                    return 0
+            else:
+                return 0
+        return ni
 
-    def _collect_subtree_links(self, ni, res):
-        # Explicit recursion using a stack.
-        # Needs to differentiate when a node has been
-        # added (state=0) and when it is to be removed
-        # (state=1) to update the current path accordingly.
+    def _get_value(self, s):
+        if self._stats is not None:
+            t0 = time.time()
+            counters = TrieDict._new_counters()
+            ni = self._get_pattern_node_with_stats(s, counters)
+        else:
+            ni = self._get_pattern_node(s)
+        value = None
+        if ni != 0:
+            nd = self._p[ni]
+            if nd.value != 0:
+                value = nd.value - 1
+        if self._stats is not None:
+            counters["matches_emitted"] = 1 if value is not None else 0
+            self._record_stats("get", counters, t0)
+        return value
+
+    def _prefix_search(self, prefix, join_patterns):
+        if self._stats is not None:
+            t0 = time.time()
+            counters = TrieDict._new_counters()
+            ni = self._get_pattern_node_with_stats(prefix, counters)
+        else:
+            ni = self._get_pattern_node(prefix)
+        res = []
+        if ni != 0:
+            self._collect_subtree_links(ni, res)
 
-        #    (state, nodeIdx)
-        stack = [(0, ni)]
-        path = []
-        while len(stack) > 0:
-            state, ni = stack.pop()
-            if state == 1:
-                path.pop()
-            else:
-                stack.append((1, ni))
-                nd = self._p[ni]
-                path.append(nd.symbol)
-                if nd.value != 0:
-                    res.append((path[1:], nd.value))
-                child_ni = nd.p_child
-                while child_ni != 0:
-                    stack.append((0, child_ni))
-                    child_ni = self._p[child_ni].p_brother
+        self._decode_pattern_result(res, join_patterns)
+        if self._stats is not None:
+            counters["matches_emitted"] = len(res)
+            self._record_stats("prefix_search", counters, t0)
+        return res
 
-    def _increase_mem(self):
+    def _encode_pattern(self, s):
         """
-        Doubles the size of the node array.
-        The size must be increased on the _data
-        member, since this ctype object owns the memory.
+        Returns the encoded (and normalized) symbols
+        of pattern s as a tuple.
         """
+        codes = [self._symbol_encoder(symbol) for symbol in s]
+        norm = self._norm
+        if norm is not None:
+            n_norm = len(norm)
+            codes = [norm[c] if c < n_norm else c for c in codes]
+        return tuple(codes)
+
+    def _cache_lookup(self, key):
+        with self._cache_lock:
+            if self._cache is None:
+                # disabled by another thread
+                return _NOT_CACHED
+            res = self._cache.pop(key, _NOT_CACHED)
+            if res is _NOT_CACHED:
+                self._cache_misses += 1
+            else:
+                # re-insert as most recently used
+                self._cache[key] = res
+                self._cache_hits += 1
+            return res
+
+    def _cache_store(self, key, res):
+        with self._cache_lock:
+            if self._cache is None:
+                return
+            self._cache[key] = res
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _invalidate_cache(self, codes):
+        """
+        Drops the cached results that are affected by a
+        modification of the encoded pattern [codes]: its
+        lookup and the prefix searches of all its prefixes.
+        """
+        with self._cache_lock:
+            if self._cache is None:
+                return
+            self._cache.pop(("get", codes), None)
+            for i in xrange(len(codes)+1):
+                prefix = codes[:i]
+                self._cache.pop(("prefix_search", prefix, True), None)
+                self._cache.pop(("prefix_search", prefix, False), None)
+
+    def _insert(self, codes, value):
+        """
+        Stores the encoded pattern [codes] with the
+        internal [value] (patternID + 1).
+        """
+        ni = 0
+        nd = self._getnode(ni) # current node object (root)
 
-        s_bytes = self._buf_nodes * sizeof(Node)
-        if s_bytes != sizeof(self._data):
-            raise ValueError("Internal Error!")
-
-        resize(self._data, s_bytes*2)
-        memset(byref(self._data, s_bytes), 0, s_bytes)
-
-        self._buf_nodes *= 2
-        # Renew the pointer since the arrays' memory
-        # might have been moved.
-        self._p = TrieDict._P(self._data)
-
-    def _create_new_node(self, symbol, parent_ni):
+        for c in codes:
+            if c == 0:
+                raise ValueError("encoded symbol should not have value 0!")
+            if nd.p_child == 0:
+                # Node has no child yet;
+                # create new child node
+                nni, nnd = self._create_new_node(c, ni)
+                # The pointer _p might have changed
+                # when the array was increased (since the increase
+                # can move the arrays' memory block).
+                # Since the nodes are aware of the pointer
+                # by which they have been retrieved,
+                # we need to get the node once again after a
+                # create_new_node() call.
+                nd = self._getnode(ni)
+
+                # now make the new node the current node
+                nd.p_child = nni
+                nd = nnd
+                ni = nni
+                continue
+            else:
+                # follow the linked list starting with
+                # the child to find matching node
+                parent_ni = ni
+                ni = nd.p_child
+                nd = self._getnode(ni)
+                while nd.p_brother != 0 and nd.symbol != c:
+                    ni = nd.p_brother
+                    nd = self._getnode(ni)
+                if nd.symbol != c:
+                    # no matching node has been found;
+                    # create new brother node
+                    nni, nnd = self._create_new_node(c, parent_ni)
+                    nd = self._getnode(ni)
+                    nd.p_brother = nni
+                    nd = nnd
+                    ni = nni
+        if nd.value == 0:
+            self._header.n_patterns += 1
+        nd.value = value
+        if self._max_depth is not None and len(codes) > self._max_depth:
+            self._max_depth = len(codes)
+
+    def _remove(self, codes):
+        ni = self._get_code_node(codes)
+        if ni == 0 or self._p[ni].value == 0:
+            return False
+        self._p[ni].value = 0
+        self._header.n_patterns -= 1
+        return True
+
+    def _get_code_node(self, codes):
+        """
+        Same as #_get_pattern_node(s) for the
+        encoded pattern [codes].
+        """
+        ni = 0
+        nd = self._p[ni]
+        for c in codes:
+            ni, nd = self._get_matching_child(nd, c)
+            if ni is None:
+                return 0
+        return ni
+
+    def _iter_patterns(self):
+        """
+        Generates the (codes, value) tuples of all patterns
+        stored in the dictionary; value is the internal
+        value (patternID + 1).
+        """
+        # see #_collect_subtree_links()
+        stack = [(0, 0)]
+        path = []
+        while len(stack) > 0:
+            state, ni = stack.pop()
+            if state == 1:
+                path.pop()
+            else:
+                stack.append((1, ni))
+                nd = self._p[ni]
+                path.append(nd.symbol)
+                if nd.value != 0:
+                    yield tuple(path[1:]), nd.value
+                child_ni = nd.p_child
+                while child_ni != 0:
+                    stack.append((0, child_ni))
+                    child_ni = self._p[child_ni].p_brother
+
+    def _get_matching_child(self, nd, symbol):
+        """
+        Returns a (nodeIdx, node) tuple of
+        that child node of [nd], that matches
+        [symbol], otherwise (None, None).
+        """
+        child_ni = nd.p_child
+        while child_ni != 0:
+            child_nd = self._p[child_ni]
+            if child_nd.symbol == symbol:
+                return child_ni, child_nd
+            child_ni = child_nd.p_brother
+        return None, None
+
+    def _collect_subtree_links(self, ni, res):
+        # Explicit recursion using a stack.
+        # Needs to differentiate when a node has been
+        # added (state=0) and when it is to be removed
+        # (state=1) to update the current path accordingly.
+
+        #    (state, nodeIdx)
+        stack = [(0, ni)]
+        path = []
+        while len(stack) > 0:
+            state, ni = stack.pop()
+            if state == 1:
+                path.pop()
+            else:
+                stack.append((1, ni))
+                nd = self._p[ni]
+                path.append(nd.symbol)
+                if nd.value != 0:
+                    res.append((path[1:], nd.value))
+                child_ni = nd.p_child
+                while child_ni != 0:
+                    stack.append((0, child_ni))
+                    child_ni = self._p[child_ni].p_brother
+
+    def _increase_mem(self):
+        """
+        Doubles the size of the node array.
+        The size must be increased on the _data
+        member, since this ctype object owns the memory.
+        """
+
+        s_bytes = self._buf_nodes * sizeof(Node)
+        if s_bytes != sizeof(self._data):
+            raise ValueError("Internal Error!")
+
+        resize(self._data, s_bytes*2)
+        memset(byref(self._data, s_bytes), 0, s_bytes)
+
+        self._buf_nodes *= 2
+        # Renew the pointer since the arrays' memory
+        # might have been moved.
+        self._p = TrieDict._P(self._data)
+
+    def _prepare_write(self):
+        """
+        Needs to be called before the dictionary is modified.
+        """
+
+        if self._frozen:
+            raise ValueError("snapshot is read-only!")
+        self._ensure_private_data()
+        self._fn = None
+
+    @staticmethod
+    def _delta_fn(fn):
+        return fn + ".delta"
+
+    def _write(self, fn):
+        """
+        Writes the header and the used nodes to file [fn].
+        The data is written to a unique temporary file in the
+        same directory first, which then replaces [fn]. Hence,
+        concurrent writers do not overwrite each others data.
+        """
+        fd, tmp_fn = TrieDict._create_tmp_file(fn)
+        try:
+            fp = os.fdopen(fd, "wb")
+            file_header = FileHeader()
+            file_header.magic = FILE_MAGIC
+            file_header.version = FILE_VERSION
+            fp.write(file_header)
+            fp.write(self._header)
+            fp.write(buffer(self._data, 0, self._header.n_nodes * sizeof(Node)))
+            if self._norm is not None:
+                self._norm.tofile(fp)
+            self._write_extra(fp)
+            fp.close()
+            if os.path.exists(fn):
+                os.chmod(tmp_fn, stat.S_IMODE(os.stat(fn).st_mode))
+            os.rename(tmp_fn, fn)
+        except:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
+
+    @staticmethod
+    def _create_tmp_file(fn):
+        """
+        Creates a new temporary file next to file [fn]. Unlike
+        tempfile.mkstemp(), the file gets the default permissions
+        (0666 minus the current umask).
+
+        Returns:
+            A tuple (file descriptor, filename).
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        while True:
+            tmp_fn = "%s.%08x.tmp" % (fn, random.getrandbits(32))
+            try:
+                return os.open(tmp_fn, flags, 0666), tmp_fn
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def _read_header(fp):
+        """
+        Reads the header of the file [fp] (legacy files
+        are supported) and leaves [fp] at the first node.
+
+        Returns:
+            A tuple (header, offset of the first node).
+        """
+        file_header = FileHeader()
+        if fp.readinto(file_header) == sizeof(file_header) and \
+                file_header.magic == FILE_MAGIC:
+            if file_header.version != FILE_VERSION:
+                raise ValueError("unsupported file version %d!" % file_header.version)
+            header = Header()
+            if fp.readinto(header) != sizeof(header):
+                raise ValueError("truncated file!")
+            return header, sizeof(FileHeader) + sizeof(Header)
+
+        fp.seek(0)
+        legacy = LegacyHeader()
+        if fp.readinto(legacy) != sizeof(legacy):
+            raise ValueError("truncated file!")
+        header = Header()
+        header.n_nodes = legacy.n_nodes
+        header.n_patterns = legacy.n_patterns
+        header.has_suffix_pointers = legacy.has_suffix_pointers
+        return header, sizeof(LegacyHeader)
+
+    def _write_extra(self, fp):
+        """
+        Writes additional data of subclasses after the nodes.
+        """
+        pass
+
+    def _read_extra(self, fp):
+        """
+        Reads the data written by #_write_extra() from
+        the file object [fp], positioned at its start.
+        """
+        pass
+
+    def _new_snapshot(self):
+        """
+        Returns an empty dictionary that becomes
+        a snapshot of this one (see #snapshot()).
+        """
+        return TrieDict(1, self._symbol_encoder, self._symbol_decoder)
+
+    def _merged_codes(self, other, codes):
+        """
+        Returns the encoded pattern [codes] of dictionary
+        [other] in the encoding of this dictionary
+        (see #merge()).
+        """
+        return codes
+
+    @staticmethod
+    def _delta_generation(delta_fn):
+        """
+        Returns the generation of the delta log [delta_fn],
+        or None if there is no (valid) log.
+        """
+        if not os.path.exists(delta_fn):
+            return None
+        fp = open(delta_fn, "rb")
+        log_header = DeltaLogHeader()
+        n = fp.readinto(log_header)
+        fp.close()
+        if n != sizeof(log_header):
+            return None
+        return log_header.generation
+
+    def _replay_delta(self, delta_fn):
+        if TrieDict._delta_generation(delta_fn) != self._header.generation:
+            # obsolete log of an earlier version
+            return
+        fp = open(delta_fn, "rb")
+        buf = fp.read()
+        fp.close()
+
+        pos = sizeof(DeltaLogHeader)
+        n_nodes = self._header.n_nodes
+        while pos + sizeof(DeltaRecord) <= len(buf):
+            record = DeltaRecord.from_buffer_copy(buf, pos)
+            pos += sizeof(DeltaRecord)
+            end = pos + record.length * 4
+            if end > len(buf):
+                # incomplete record of an interrupted #save_delta()
+                break
+            codes = array("I")
+            codes.fromstring(buf[pos:end])
+            pos = end
+            # Updates and removals only change the values of existing
+            # nodes. They are written to the (copy-on-write) mapping,
+            # such that only the touched pages are copied.
+            if record.op == TrieDict._DELTA_SET:
+                if self._get_code_node(codes) == 0:
+                    # new nodes need a private, resizable array
+                    self._prepare_write()
+                self._insert(codes, record.value)
+            elif record.op == TrieDict._DELTA_REMOVE:
+                self._remove(codes)
+            else:
+                raise ValueError("invalid delta record!")
+
+        if self._header.n_nodes != n_nodes and self._header.has_suffix_pointers:
+            # the suffix pointers of (and to) the new nodes are
+            # missing; see #load()
+            self._header.has_suffix_pointers = False
+            self._suffix_pointers_dropped = True
+
+    def _ensure_private_data(self):
+        """
+        Copies a shared (e.g., memory-mapped) node array
+        into an array owned by this object, such that it
+        can be modified and resized.
+        """
+
+        if not self._shared:
+            return
+        n_nodes = self._header.n_nodes
+        data = (Node * self._buf_nodes)()
+        memmove(data, self._data, n_nodes * sizeof(Node))
+        self._header = Header.from_buffer_copy(self._header)
+        self._data = data
+        self._p = TrieDict._P(self._data)
+        self._buf_nodes = len(data)
+        self._shared = False
+        self._mmap = None
+
+    def _max_pattern_length(self):
+        """
+        Returns the length of the longest pattern (depth of the
+        Trie). The depth is kept up to date by #_insert(). It is
+        only computed from the nodes once after #load(). Removed
+        patterns keep their nodes, so the result is an upper bound.
+        """
+        if self._max_depth is not None:
+            return self._max_depth
+
+        # Parents are always created before their children,
+        # hence, the depths can be computed in one pass.
+        depths = array("I", [0]) * self._header.n_nodes
+        max_depth = 0
+        for ni in xrange(1, self._header.n_nodes):
+            depth = depths[self._p[ni].p_parent] + 1
+            depths[ni] = depth
+            if depth > max_depth:
+                max_depth = depth
+        self._max_depth = max_depth
+        return max_depth
+
+    def _parse_many_serial(self, documents, join_patterns, bound_chars):
+        for doc_idx, s in enumerate(documents):
+            for m in self.parse(s, join_patterns, bound_chars):
+                yield (doc_idx,) + m
+
+    def _parse_many_parallel(self, documents, workers, join_patterns,
+                             bound_chars, chunk_size):
+        fn = self._fn
+        tmp_fn = None
+        # The workers would replay a delta log on private
+        # copies of the Trie, so the full state is saved.
+        if fn is None or os.path.exists(TrieDict._delta_fn(fn)):
+            fd, tmp_fn = tempfile.mkstemp(suffix=".triedict")
+            os.close(fd)
+            self._write(tmp_fn)
+            fn = tmp_fn
+
+        # Matches end at most [overlap-1] symbols after their start.
+        # One more symbol is needed to check the bound chars.
+        overlap = self._max_pattern_length()
+        pool = multiprocessing.Pool(workers, _parse_many_init,
+                                    (fn, self._symbol_encoder, self._symbol_decoder))
+        try:
+            # Keep a bounded number of tasks in flight, such that
+            # the documents are consumed as a stream.
+            pending = deque()
+            for batch in TrieDict._split_documents(documents, chunk_size, overlap):
+                pending.append(pool.apply_async(_parse_many_batch,
+                                                (batch, join_patterns, bound_chars)))
+                if len(pending) >= 2*workers:
+                    for m in pending.popleft().get():
+                        yield m
+            while len(pending) > 0:
+                for m in pending.popleft().get():
+                    yield m
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            if tmp_fn is not None:
+                os.remove(tmp_fn)
+
+    @staticmethod
+    def _split_documents(documents, chunk_size, overlap):
+        """
+        Generates batches (lists) of (docIdx, chunk, offset, keep_start,
+        keep_end) tasks. Only matches ending in chunk[keep_start:keep_end]
+        are reported for a chunk; the symbols before and after this range
+        are only used to complete matches and bound checks. Small
+        documents are batched until a batch holds about [chunk_size]
+        symbols, such that one task is not sent per document.
+        """
+        batch = []
+        n_symbols = 0
+        for doc_idx, s in enumerate(documents):
+            m = len(s)
+            start = 0
+            while start < m:
+                end = min(start + chunk_size - n_symbols, m)
+                lo = max(0, start - overlap)
+                hi = min(m, end + 1)
+                batch.append((doc_idx, s[lo:hi], lo, start - lo, end - lo))
+                n_symbols += end - start
+                start = end
+                if n_symbols >= chunk_size:
+                    yield batch
+                    batch = []
+                    n_symbols = 0
+        if len(batch) > 0:
+            yield batch
+
+    def _create_new_node(self, symbol, parent_ni):
         if self._header.n_nodes >= self._buf_nodes:
             self._increase_mem()
         ni = self._header.n_nodes
@@ -626,7 +1749,7 @@ class TrieDict(object):
             for i in xrange(len(suffix)):
                 suffix[i] = self._symbol_decoder(suffix[i])
             if join_patterns:
-                suffix = "".join(suffix)
+                suffix = self._JOIN_SEPARATOR.join(suffix)
             res[j] = (suffix, res[j][1]-1) + res[j][2:]
 
     @staticmethod
@@ -641,6 +1764,927 @@ class TrieDict(object):
                     (end_pos == m-1 or s[end_pos+1] in bound_chars)):
                 del res[i]
 
+    # STATS MODE //////////////////////////////////////////////////////
+
+    @staticmethod
+    def _new_counters():
+        return dict((name, 0) for name in STATS_COUNTERS)
+
+    def _record_stats(self, method, counters, t0):
+        counters["calls"] = 1
+        counters["seconds"] = time.time() - t0
+        for name in STATS_COUNTERS:
+            self._stats[name] += counters[name]
+        self._last_stats = counters
+        for hook in self._stats_hooks:
+            hook(method, counters)
+
+    def _record_cache_hit(self, method, n_results, t0):
+        counters = TrieDict._new_counters()
+        counters["cache_hits"] = 1
+        counters["matches_emitted"] = n_results
+        self._record_stats(method, counters, t0)
+
+    def _get_pattern_node_with_stats(self, s, counters):
+        """
+        Instrumented version of #_get_pattern_node().
+        """
+        nodes_visited = 0
+        sibling_comparisons = 0
+        ni = 0
+        nd = self._p[ni]
+        norm = self._norm
+        n_norm = len(norm) if norm is not None else 0
+        for symbol in s:
+            c = self._symbol_encoder(symbol)
+            if c < n_norm:
+                c = norm[c]
+            if nd.p_child == 0:
+                ni = 0
+                break
+            ni = nd.p_child
+            nd = self._p[ni]
+            sibling_comparisons += 1
+            while nd.p_brother != 0 and nd.symbol != c:
+                ni = nd.p_brother
+                nd = self._p[ni]
+                sibling_comparisons += 1
+            if nd.symbol != c:
+                ni = 0
+                break
+            nodes_visited += 1
+        counters["nodes_visited"] += nodes_visited
+        counters["sibling_comparisons"] += sibling_comparisons
+        return ni
+
+    def _parse_with_stats(self, s, join_patterns, bound_chars):
+        """
+        Instrumented version of #parse(). Its loop mirrors
+        the one of #parse() and must be kept in sync.
+        """
+        t0 = time.time()
+        counters = TrieDict._new_counters()
+        nodes_visited = 0
+        sibling_comparisons = 0
+        suffix_hops = 0
+        output_hops = 0
+        path_symbols = 0
+
+        matched = []
+        ni = 0
+        nd = self._p[ni]
+        pos = 0
+        m = len(s)
+        norm = self._norm
+        n_norm = len(norm) if norm is not None else 0
+        while pos < m:
+            c = self._symbol_encoder(s[pos])
+            if c < n_norm:
+                c = norm[c]
+
+            # see #_get_matching_child()
+            child_ni = nd.p_child
+            child_nd = None
+            while child_ni != 0:
+                child_nd = self._p[child_ni]
+                sibling_comparisons += 1
+                if child_nd.symbol == c:
+                    break
+                child_ni = child_nd.p_brother
+
+            if child_ni == 0:
+                if nd.is_root():
+                    pos += 1
+                else:
+                    ni = nd.p_suffix
+                    nd = self._p[ni]
+                    suffix_hops += 1
+                continue
+
+            ni = child_ni
+            nd = child_nd
+            nodes_visited += 1
+
+            suff_path_ni = ni
+            suff_path_nd = self._p[suff_path_ni]
+            while not suff_path_nd.is_root():
+                if suff_path_nd.is_pattern():
+                    path = self._get_path(suff_path_ni)
+                    path_symbols += len(path)
+                    matched.append((path, suff_path_nd.value, pos))
+                suff_path_ni = suff_path_nd.p_suffix
+                suff_path_nd = self._p[suff_path_ni]
+                output_hops += 1
+            pos += 1
+
+        self._decode_pattern_result(matched, join_patterns)
+        n_matched = len(matched)
+        if bound_chars:
+            TrieDict._remove_matches_without_bounds(s, matched, bound_chars)
+
+        counters["nodes_visited"] = nodes_visited
+        counters["sibling_comparisons"] = sibling_comparisons
+        counters["suffix_hops"] = suffix_hops
+        counters["output_hops"] = output_hops
+        counters["path_symbols"] = path_symbols
+        counters["matches_emitted"] = len(matched)
+        counters["matches_rejected_by_bounds"] = n_matched - len(matched)
+        self._record_stats("parse", counters, t0)
+        return matched
+
+
+class PhraseTrieDict(TrieDict):
+    """
+    Trie-based dictionary of phrases (token sequences).
+
+    The phrases and texts (unicode strings) are split into
+    tokens by a regular expression and the tokens are mapped to dense integer IDs by
+    a vocabulary, which is saved in the same file as the Trie.
+    The Trie and the Aho-Corasick automaton work on the token
+    IDs, so a phrase of n tokens takes n nodes, and matches
+    always start and end at token boundaries.
+
+    The vocabulary can be shared by snapshots, since tokens
+    are only ever added to it; a snapshot only sees the tokens
+    added before it was taken. Delta logs, normalization tables
+    and #parse_many() are not supported in phrase mode.
+    """
+
+    DEF_TOKEN_PATTERN = r"\w+"
+
+    # ID of the tokens of a text that are not in the vocabulary
+    _UNKNOWN_TOKEN = 2**32-1
+
+    _JOIN_SEPARATOR = " "
+
+    def __init__(self, init_n=1, token_pattern=None):
+        """
+        Constructs a new phrase dictionary.
+
+        Args:
+            init_n: Inital number of buffer nodes (size of
+                the underlying array).
+            token_pattern: The regular expression matching a token
+                (unicode flag set). Defaults to DEF_TOKEN_PATTERN.
+        """
+        # id -> token; ID 0 is the symbol of the root node
+        self._tokens = [None]
+        # token -> id
+        self._token_ids = {}
+        # length of _tokens seen by a snapshot (None: all)
+        self._tokens_len = None
+        TrieDict.__init__(self, init_n, int, self._tokens.__getitem__)
+        self._set_token_pattern(token_pattern or PhraseTrieDict.DEF_TOKEN_PATTERN)
+
+    # INTERFACE ///////////////////////////////////////////////////////////
+
+    @classmethod
+    def load(cls, fn, use_mmap=False):
+        """
+        Loads the dictionary and its vocabulary from disc.
+        See TrieDict#load()
+        """
+        triedict = super(PhraseTrieDict, cls).load(fn, use_mmap)
+        # modifications are not tracked (see #save_delta())
+        triedict._delta = None
+        return triedict
+
+    def save(self, fn):
+        """
+        Serializes the dictionary and its vocabulary to file [fn].
+        See TrieDict#save()
+        """
+        TrieDict.save(self, fn)
+        self._delta = None
+
+    def tokenize(self, s):
+        """
+        Generates the (token, start, end) tuples of the
+        tokens in the unicode string s; s[start:end] == token.
+        """
+        # \w would split the UTF-8 bytes of a str
+        if not isinstance(s, unicode):
+            raise ValueError("phrases and texts must be unicode!")
+        for m in self._token_re.finditer(s):
+            yield m.group(), m.start(), m.end()
+
+    def vocabulary_size(self):
+        """
+        Number of distinct tokens in the vocabulary.
+        """
+        return self._tokens_end() - 1
+
+    def token_id(self, token):
+        """
+        Returns the ID of [token] or None, if the
+        token is not in the vocabulary.
+        """
+        token_id = self._token_ids.get(token)
+        if token_id is not None and token_id >= self._tokens_end():
+            return None
+        return token_id
+
+    def add_pattern(self, s, patternID=1):
+        """
+        Adds the phrase s to the dictionary.
+        See TrieDict#add_pattern()
+        """
+        if self._frozen:
+            raise ValueError("snapshot is read-only!")
+        # checked before the tokens are added to the vocabulary
+        if (patternID < 0) or (patternID > TrieDict._MAX_PATTERN_ID):
+            raise ValueError("patternID must be in range [0,2**32-2]!")
+        ids = [self._add_token(token) for token, start, end in self.tokenize(s)]
+        if len(ids) == 0:
+            raise ValueError("phrase has no tokens!")
+        TrieDict.add_pattern(self, ids, patternID)
+
+    def remove_pattern(self, s):
+        ids = self._token_ids_of(s)
+        if ids is None:
+            return False
+        return TrieDict.remove_pattern(self, ids)
+
+    def get(self, s):
+        """
+        Returns the value of the phrase s or None,
+        if the phrase is not stored in the dictionary.
+        """
+        ids = self._token_ids_of(s)
+        if ids is None:
+            return None
+        return TrieDict._get_dispatched(self, ids)
+
+    def prefix_search(self, prefix, join_patterns=True):
+        """
+        Returns the remaining tokens of the phrases that start
+        with the tokens of phrase [prefix]. If join_patterns is
+        True, the tokens are joined by a space.
+
+        Returns:
+            A list of (suffix, value) tuples.
+        """
+        ids = self._token_ids_of(prefix)
+        if ids is None:
+            return []
+        return TrieDict._prefix_search_dispatched(self, ids, join_patterns)
+
+    def parse(self, s, join_patterns=True, bound_chars=None):
+        """
+        Finds all stored phrases that occur in the string s
+        in one pass over its tokens.
+
+        Args:
+            s: A unicode string.
+            join_patterns: If True, the tokens of a matched phrase
+              are joined by a space, else, they are returned as
+              a list.
+            bound_chars: Not supported (must be None), since
+              matches always start and end at token boundaries.
+
+        Returns:
+            A list of (phrase, value, (token_start, token_end),
+            (char_start, char_end)) tuples. The spans are half-open:
+            s[char_start:char_end] is the matched text.
+        """
+        if bound_chars is not None:
+            raise ValueError("bound_chars not supported by PhraseTrieDict!")
+        ids = array("I")
+        starts = []
+        ends = []
+        for token, start, end in self.tokenize(s):
+            ids.append(self._token_ids.get(token, PhraseTrieDict._UNKNOWN_TOKEN))
+            starts.append(start)
+            ends.append(end)
+
+        matched = TrieDict.parse(self, ids, join_patterns=False)
+        for i in xrange(len(matched)):
+            tokens, value, token_end = matched[i]
+            token_start = token_end + 1 - len(tokens)
+            if join_patterns:
+                tokens = PhraseTrieDict._JOIN_SEPARATOR.join(tokens)
+            matched[i] = (tokens, value, (token_start, token_end + 1),
+                          (starts[token_start], ends[token_end]))
+        return matched
+
+    def merge(self, other):
+        """
+        Adds all phrases of the PhraseTrieDict [other]. Its
+        tokens are added to the vocabulary of this dictionary.
+        See TrieDict#merge()
+        """
+        if not isinstance(other, PhraseTrieDict):
+            raise ValueError("only a PhraseTrieDict can be merged!")
+        TrieDict.merge(self, other)
+
+    def parse_many(self, documents, workers=1, join_patterns=True,
+                   bound_chars=None, chunk_size=2**20):
+        raise ValueError("parse_many not supported by PhraseTrieDict!")
+
+    def save_delta(self, fn):
+        # The log would also need the tokens added to the vocabulary.
+        raise ValueError("delta logs not supported by PhraseTrieDict, use save()!")
+
+    def set_normalization(self, table):
+        raise ValueError("normalization not supported by PhraseTrieDict!")
+
+    # HELPERS /////////////////////////////////////////////////////////
+
+    def _set_token_pattern(self, token_pattern):
+        self._token_pattern = token_pattern
+        self._token_re = re.compile(token_pattern, re.UNICODE)
+
+    def _tokens_end(self):
+        if self._tokens_len is not None:
+            return self._tokens_len
+        return len(self._tokens)
+
+    def _add_token(self, token):
+        token_id = self._token_ids.get(token)
+        if token_id is None:
+            token_id = len(self._tokens)
+            if token_id >= PhraseTrieDict._UNKNOWN_TOKEN:
+                raise ValueError("vocabulary is full!")
+            self._tokens.append(token)
+            self._token_ids[token] = token_id
+        return token_id
+
+    def _token_ids_of(self, s):
+        """
+        Returns the list of token IDs of phrase s, or None
+        if one of its tokens is not in the vocabulary.
+        """
+        ids = []
+        for token, start, end in self.tokenize(s):
+            token_id = self._token_ids.get(token)
+            if token_id is None:
+                return None
+            ids.append(token_id)
+        return ids
+
+    def _write_extra(self, fp):
+        token_pattern = self._token_pattern.encode("utf-8")
+        tokens = [token.encode("utf-8") for token in self._tokens[1:self._tokens_end()]]
+        header = VocabularyHeader()
+        header.n_tokens = len(tokens)
+        header.token_pattern_len = len(token_pattern)
+        fp.write(header)
+        fp.write(token_pattern)
+        array("I", [len(token) for token in tokens]).tofile(fp)
+        for token in tokens:
+            fp.write(token)
+
+    def _read_extra(self, fp):
+        header = VocabularyHeader()
+        if fp.readinto(header) != sizeof(header):
+            raise ValueError("file has no vocabulary!")
+        token_pattern = fp.read(header.token_pattern_len).decode("utf-8")
+        lengths = array("I")
+        lengths.fromstring(fp.read(header.n_tokens*4))
+        data = fp.read(sum(lengths))
+        if len(lengths) != header.n_tokens or len(data) != sum(lengths):
+            raise ValueError("truncated file!")
+
+        self._set_token_pattern(token_pattern)
+        pos = 0
+        for length in lengths:
+            token = data[pos:pos+length].decode("utf-8")
+            pos += length
+            self._token_ids[token] = len(self._tokens)
+            self._tokens.append(token)
+
+    def _update_query_methods(self):
+        # #get() and #prefix_search() always use the dispatched
+        # variants (the tokenization dominates their costs).
+        pass
+
+    def _merged_codes(self, other, codes):
+        # map the token IDs of [other] to the IDs of this vocabulary
+        return [self._add_token(other._tokens[c]) for c in codes]
+
+    def _new_snapshot(self):
+        snap = PhraseTrieDict(1, self._token_pattern)
+        snap._tokens = self._tokens
+        snap._token_ids = self._token_ids
+        snap._tokens_len = self._tokens_end()
+        snap._symbol_decoder = self._tokens.__getitem__
+        return snap
+
+
+def build_normalization_table(symbols=None, case_folding=True, strip_accents=True):
+    """
+    Builds a normalization table for TrieDict#set_normalization()
+    that maps unicode characters to their lower-case and/or
+    unaccented form. Characters that would be mapped to more than
+    one character (e.g., ligatures) are not included.
+
+    Args:
+        symbols: The unicode characters to include. Defaults to
+          the Latin, Greek and Cyrillic characters (U+0000-U+04FF).
+        case_folding: If True, characters are lower-cased.
+        strip_accents: If True, combining marks are removed.
+
+    Returns:
+        A dict <unicode char> -> <unicode char>.
+    """
+    if symbols is None:
+        symbols = [unichr(i) for i in xrange(0x500)]
+    table = {}
+    for symbol in symbols:
+        norm_symbol = unicode(symbol)
+        if case_folding:
+            norm_symbol = norm_symbol.lower()
+        if strip_accents:
+            norm_symbol = u"".join([c for c in unicodedata.normalize("NFD", norm_symbol)
+                                    if not unicodedata.combining(c)])
+        if len(norm_symbol) == 1 and norm_symbol != symbol:
+            table[symbol] = norm_symbol
+    return table
+
+
+class TrieDictHandle(object):
+    """
+    Reference to the latest published version of a dictionary.
+
+    Readers query the handle (or take a #snapshot() to run several
+    queries on the same version), while a writer builds a new
+    TrieDict and #publish()es it. Publishing replaces a single
+    reference to a read-only snapshot, so readers are never blocked
+    and never see a dictionary that is being modified.
+    """
+
+    def __init__(self, triedict=None):
+        self._current = None
+        self._watcher = None
+        self._stop_watching = threading.Event()
+        if triedict is not None:
+            self.publish(triedict)
+
+    def publish(self, triedict):
+        """
+        Makes a snapshot of [triedict] the current version.
+        """
+        self._current = triedict.snapshot()
+
+    def snapshot(self):
+        """
+        Returns the current version (a read-only TrieDict).
+        """
+        return self._current
+
+    def lookup(self, s):
+        return self._current.get(s)
+
+    def get(self, s):
+        return self._current.get(s)
+
+    def prefix_search(self, prefix, join_patterns=True):
+        return self._current.prefix_search(prefix, join_patterns)
+
+    def match(self, s, join_patterns=True, bound_chars=None):
+        return self._current.parse(s, join_patterns, bound_chars)
+
+    def parse(self, s, join_patterns=True, bound_chars=None):
+        return self._current.parse(s, join_patterns, bound_chars)
+
+    def watch(self, fn, interval=1.0, use_mmap=False, dict_class=None):
+        """
+        Publishes the dictionary stored in file [fn] and starts
+        a daemon thread that publishes it again whenever the file
+        is replaced. Files that cannot be loaded are skipped.
+        [dict_class] is the class used to load the file (defaults
+        to TrieDict). See TrieDict#watch() for use_mmap.
+        """
+        if dict_class is None:
+            dict_class = TrieDict
+        if self._watcher is not None:
+            raise ValueError("handle is already watching a file!")
+        # stat before loading, such that a replacement of the
+        # file during the load is not missed.
+        stat = TrieDictHandle._file_stat(fn)
+        self.publish(TrieDictHandle._load(dict_class, fn, use_mmap))
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch,
+                                         args=(fn, interval, use_mmap, dict_class, stat))
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop(self):
+        """
+        Stops watching the file (see #watch()).
+        """
+        if self._watcher is None:
+            return
+        self._stop_watching.set()
+        self._watcher.join()
+        self._watcher = None
+
+    def _watch(self, fn, interval, use_mmap, dict_class, last_stat):
+        while True:
+            self._stop_watching.wait(interval)
+            if self._stop_watching.is_set():
+                return
+            stat = TrieDictHandle._file_stat(fn)
+            if stat is None or stat == last_stat:
+                continue
+            try:
+                triedict = TrieDictHandle._load(dict_class, fn, use_mmap)
+            except (IOError, OSError, ValueError):
+                continue
+            last_stat = stat
+            self.publish(triedict)
+
+    @staticmethod
+    def _load(dict_class, fn, use_mmap):
+        triedict = dict_class.load(fn, use_mmap)
+        if triedict._suffix_pointers_dropped:
+            # regenerate them in the watching thread, not
+            # in the threads of the readers
+            triedict.generate_suffix_links(verbose=False)
+        return triedict
+
+    @staticmethod
+    def _file_stat(fn):
+        """
+        Returns the state of file [fn] and of its delta log (see
+        TrieDict#save_delta()), or None if [fn] does not exist.
+        """
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        try:
+            delta_st = os.stat(TrieDict._delta_fn(fn))
+            delta_stat = (delta_st.st_ino, delta_st.st_size, delta_st.st_mtime)
+        except OSError:
+            delta_stat = None
+        return (st.st_ino, st.st_size, st.st_mtime, delta_stat)
+
+    def __len__(self):
+        return len(self._current)
+
+    def __contains__(self, key):
+        return key in self._current
+
+    def __getitem__(self, key):
+        return self._current[key]
+
+    def __repr__(self):
+        return "TrieDictHandle(%r)" % self._current
+
+
+class ShardedTrieDict(object):
+    """
+    Dictionary that partitions its patterns on several
+    TrieDicts (shards). Each shard has its own node array, so
+    the total number of nodes is not limited by the uint32
+    pointers of a single TrieDict.
+
+    Patterns are assigned to shards either by their leading
+    symbol (partition="symbol"), which allows to answer prefix
+    searches by a single shard, or by a hash of the whole
+    pattern (partition="hash"), which balances the shards better
+    but sends prefix searches to all shards. #parse() always
+    runs on all shards.
+
+    A saved sharded dictionary can be served by one worker
+    process per shard (see #load()). The shards are then queried
+    in parallel through pipes.
+    """
+
+    PARTITIONS = ["symbol", "hash"]
+
+    # methods that can be called on the shards of worker processes
+    _WORKER_METHODS = frozenset(["get", "prefix_search", "parse", "size"])
+
+    def __init__(self, n_shards=2, partition="symbol", init_n=1,
+                 symbol_encoder=None, symbol_decoder=None):
+        """
+        Constructs a new sharded dictionary.
+
+        Args:
+            n_shards: Number of shards.
+            partition: "symbol" or "hash" (see class description).
+            init_n: Inital number of buffer nodes of each shard.
+            symbol_encoder: see TrieDict
+            symbol_decoder: see TrieDict
+        """
+        if n_shards < 1:
+            raise ValueError("n_shards must be positive!")
+        if partition not in ShardedTrieDict.PARTITIONS:
+            raise ValueError("partition must be one of %s!" % ShardedTrieDict.PARTITIONS)
+        self._partition = partition
+        self._shards = [TrieDict(init_n, symbol_encoder, symbol_decoder)
+                        for i in xrange(n_shards)]
+        # encodes (and normalizes) the patterns for routing
+        self._router = self._shards[0]
+
+        # worker processes, their connections and one lock
+        # per connection (see #load())
+        self._workers = None
+        self._conns = None
+        self._locks = None
+        # non-empty shards of the worker processes
+        self._parse_shard_ids = None
+
+    # INTERFACE ///////////////////////////////////////////////////////////
+
+    @staticmethod
+    def load(fn, use_mmap=False, workers=False,
+             symbol_encoder=None, symbol_decoder=None):
+        """
+        Loads the sharded dictionary from disc.
+
+        Args:
+            fn: The filename of the manifest file (see #save()).
+            use_mmap: see TrieDict#load()
+            workers: If True, each shard is loaded (memory-mapped)
+              by a worker process that answers the queries. The
+              dictionary is read-only then; call #close() to stop
+              the workers.
+            symbol_encoder: see TrieDict
+            symbol_decoder: see TrieDict
+        """
+        fp = open(fn, "rb")
+        header = ShardHeader()
+        fp.readinto(header)
+        fp.close()
+
+        sharded = ShardedTrieDict(header.n_shards,
+                                  ShardedTrieDict.PARTITIONS[header.partition],
+                                  1, symbol_encoder, symbol_decoder)
+        shard_fns = [ShardedTrieDict._shard_fn(fn, i) for i in xrange(header.n_shards)]
+        if workers:
+            # the first shard is only used to encode the patterns
+            router = TrieDict.load(shard_fns[0], use_mmap=True)
+            router._symbol_encoder = sharded._shards[0]._symbol_encoder
+            router._symbol_decoder = sharded._shards[0]._symbol_decoder
+            sharded._router = router
+            sharded._start_workers(shard_fns, symbol_encoder, symbol_decoder)
+            # the workers are read-only, so the
+            # empty shards never change
+            sizes = sharded._call_all("size")
+            sharded._parse_shard_ids = [i for i in xrange(len(sizes)) if sizes[i] > 0]
+        else:
+            for i, shard_fn in enumerate(shard_fns):
+                shard = TrieDict.load(shard_fn, use_mmap)
+                shard._symbol_encoder = sharded._shards[i]._symbol_encoder
+                shard._symbol_decoder = sharded._shards[i]._symbol_decoder
+                sharded._shards[i] = shard
+            sharded._router = sharded._shards[0]
+        return sharded
+
+    def save(self, fn):
+        """
+        Serializes the dictionary to the manifest file [fn]
+        and one file per shard ([fn].0, [fn].1, ...).
+        """
+        self._check_local()
+        for i, shard in enumerate(self._shards):
+            shard.save(ShardedTrieDict._shard_fn(fn, i))
+        header = ShardHeader()
+        header.n_shards = len(self._shards)
+        header.partition = ShardedTrieDict.PARTITIONS.index(self._partition)
+        fp = open(fn, "wb")
+        fp.write(header)
+        fp.close()
+
+    def close(self):
+        """
+        Stops the worker processes (see #load()).
+        """
+        if self._workers is None:
+            return
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            for conn in self._conns:
+                conn.send(None)
+                conn.close()
+            for worker in self._workers:
+                worker.join()
+            self._workers = None
+            self._conns = None
+        finally:
+            for lock in self._locks:
+                lock.release()
+            self._locks = None
+            self._parse_shard_ids = None
+
+    def set_normalization(self, table):
+        """
+        Sets the normalization table of all shards.
+        See TrieDict#set_normalization()
+        """
+        self._check_local()
+        for shard in self._shards:
+            shard.set_normalization(table)
+
+    def num_of_shards(self):
+        return len(self._shards)
+
+    def size(self):
+        """
+        Number of patterns (sequences) stored in the dictionary.
+        """
+        return sum(self._call_all("size"))
+
+    def add_pattern(self, s, patternID=1):
+        """
+        Adds a new pattern to the shard owning it.
+        See TrieDict#add_pattern()
+        """
+        self._check_local()
+        self._shards[self._shard_of(s)].add_pattern(s, patternID)
+
+    def generate_suffix_links(self, verbose=True):
+        """
+        Generates the suffix pointers of all (non-empty) shards.
+        """
+        self._check_local()
+        for shard in self._shards:
+            if shard.size() > 0:
+                shard.generate_suffix_links(verbose)
+
+    def lookup(self, s):
+        """
+        see #get(s)
+        """
+        return self.get(s)
+
+    def get(self, s):
+        """
+        Returns the value of the pattern s
+        or None, if the pattern is not stored
+        in the dictionary.
+        """
+        return self._call(self._shard_of(s), "get", s)
+
+    def prefix_search(self, prefix, join_patterns=True):
+        """
+        Returns the suffixes of the patterns that start with
+        prefix. See TrieDict#prefix_search()
+        """
+        if self._partition == "symbol" and len(prefix) > 0:
+            return self._call(self._shard_of(prefix), "prefix_search",
+                              prefix, join_patterns)
+        res = []
+        for shard_res in self._call_all("prefix_search", prefix, join_patterns):
+            res.extend(shard_res)
+        return res
+
+    def match(self, s, join_patterns=True, bound_chars=None):
+        return self.parse(s, join_patterns, bound_chars)
+
+    def parse(self, s, join_patterns=True, bound_chars=None):
+        """
+        Finds all stored patterns that occur in the string s
+        on all shards. See TrieDict#parse()
+
+        Returns.
+            A list of (pattern, value, pos) tuples ordered by pos.
+        """
+        if self._workers is not None:
+            shard_ids = self._parse_shard_ids
+        else:
+            shard_ids = [i for i in xrange(len(self._shards))
+                         if self._shards[i].size() > 0]
+        matched = []
+        for shard_res in self._call_all("parse", s, join_patterns, bound_chars,
+                                        shard_ids=shard_ids):
+            matched.extend(shard_res)
+        # the shard results are already ordered by pos
+        matched.sort(key=lambda m: m[2])
+        return matched
+
+    # OBJECT OVERWRITES /////////////////////////////////////////////////////////
+
+    def __len__(self):
+        return self.size()
+
+    def __repr__(self):
+        return "ShardedTrieDict(shards: %d, partition: %s, workers: %s)" % \
+               (len(self._shards), self._partition, self._workers is not None)
+
+    def __setitem__(self, key, value):
+        self.add_pattern(key, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    # HELPERS /////////////////////////////////////////////////////////
+
+    @staticmethod
+    def _shard_fn(fn, i):
+        return "%s.%d" % (fn, i)
+
+    def _shard_of(self, s):
+        n_shards = len(self._shards)
+        if len(s) == 0:
+            return 0
+        if self._partition == "symbol":
+            return self._router._encode_pattern(s[:1])[0] % n_shards
+        codes = array("I", self._router._encode_pattern(s))
+        return (zlib.crc32(codes.tostring()) & 0xffffffff) % n_shards
+
+    def _check_local(self):
+        if self._workers is not None:
+            raise ValueError("dictionary is served by worker processes and read-only!")
+
+    def _start_workers(self, shard_fns, symbol_encoder, symbol_decoder):
+        self._workers = []
+        self._conns = []
+        self._locks = []
+        for shard_fn in shard_fns:
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_shard_worker,
+                args=(worker_conn, shard_fn, symbol_encoder, symbol_decoder))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self._workers.append(worker)
+            self._conns.append(conn)
+            self._locks.append(threading.Lock())
+
+    def _call(self, shard_id, method, *args):
+        return self._call_all(method, *args, shard_ids=[shard_id])[0]
+
+    def _call_all(self, method, *args, **kwargs):
+        """
+        Calls [method] on the shards [shard_ids] (defaults to all
+        shards) and returns the list of results. The worker
+        processes are sent all requests before the first result
+        is received, such that they run in parallel. Each
+        connection has its own lock, so calls of several threads
+        to different shards run in parallel, too.
+        """
+        shard_ids = kwargs.get("shard_ids")
+        if shard_ids is None:
+            shard_ids = range(len(self._shards))
+        if self._workers is None:
+            return [getattr(self._shards[i], method)(*args) for i in shard_ids]
+        # take the locks in shard order to avoid deadlocks
+        locked = sorted(shard_ids)
+        for i in locked:
+            self._locks[i].acquire()
+        try:
+            for i in shard_ids:
+                self._conns[i].send((method, args))
+            results = [self._conns[i].recv() for i in shard_ids]
+        finally:
+            for i in locked:
+                self._locks[i].release()
+        for ok, res in results:
+            if not ok:
+                raise res
+        return [res for ok, res in results]
+
+
+# SHARD WORKERS ///////////////////////////////////////////////////////////
+
+def _shard_worker(conn, fn, symbol_encoder, symbol_decoder):
+    triedict = TrieDict.load(fn, use_mmap=True)
+    if symbol_encoder:
+        triedict._symbol_encoder = symbol_encoder
+    if symbol_decoder:
+        triedict._symbol_decoder = symbol_decoder
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        method, args = msg
+        try:
+            if method not in ShardedTrieDict._WORKER_METHODS:
+                raise ValueError("unsupported method %s!" % method)
+            conn.send((True, getattr(triedict, method)(*args)))
+        except Exception, e:
+            conn.send((False, e))
+    conn.close()
+
+
+# PARALLEL PARSING ////////////////////////////////////////////////////////
+
+# dictionary of a parse_many() worker process
+_worker_triedict = None
+
+def _parse_many_init(fn, symbol_encoder, symbol_decoder):
+    global _worker_triedict
+    _worker_triedict = TrieDict.load(fn, use_mmap=True)
+    _worker_triedict._symbol_encoder = symbol_encoder
+    _worker_triedict._symbol_decoder = symbol_decoder
+
+def _parse_many_batch(batch, join_patterns, bound_chars):
+    res = []
+    for doc_idx, s, offset, keep_start, keep_end in batch:
+        matched = _worker_triedict.parse(s, join_patterns, bound_chars)
+        res.extend([(doc_idx, pattern, value, pos + offset)
+                    for pattern, value, pos in matched
+                    if keep_start <= pos < keep_end])
+    return res
+
 
 if __name__ == "__main__":
     #from triedict import TrieDict